@@ -1,7 +1,11 @@
 import os # os понадобится для получения списка файлов в папке
+import json # json используется для записи изменений в журнал
 from datetime import datetime # datetime используется для сравнения дат
 
 
+JOURNAL_LIMIT = 1000 # Сколько изменений копится в журнале до слияния со снимком
+
+
 # Функции проверки корректности ввода. Они возвращают True, если всё хорошо, а иначе False
 def correct_book_name(book_name: str) -> bool:
     """
@@ -125,52 +129,131 @@ def correct_review(review: str) -> bool:
 
 # Класс для взаимодействия с файлом
 class DBWorker:
-    def __init__(self, filename: str):
+    def __init__(self, filename: str, journal: bool = False, journal_limit: int = JOURNAL_LIMIT):
         """
         При создании получает название файла, с которым работает
         Если такого файла не существует в текущей папке, он создаётся
-        Выполняется инициализация книг
+        Если включён режим журнала, изменения не перезаписывают весь файл, а дописываются
+        в журнал с именем файла и расширением .log. Когда в журнале накапливается
+        journal_limit записей, он сливается с основным файлом
+        Книги хранятся в словаре по порядковому номеру, а номера - в словаре по названию,
+        поэтому поиск книги по точному названию не требует перебора всего списка
+        Выполняется инициализация книг и применение журнала
         """
         self.filename = filename
+        self.journal = journal
+        self.journal_name = filename + ".log"
+        self.journal_limit = journal_limit
+        self.__journal_len = 0
+        self.__journal_file = None
+        self.__books = dict()
+        self.__titles = dict()
+        self.__next_id = 0
         if self.filename not in os.listdir():
             f = open(self.filename, "w")
             f.close()
         self.__init_books()
+        self.__replay_journal()
+    
+    @property
+    def books(self) -> list[list[str]]:
+        """
+        Список всех книг в порядке добавления
+        """
+        return list(self.__books.values())
     
     def __init_books(self):
         """
         Каждая книга представляется как список из 11 значений типа str
-        Все книги собраны в один список books
         Этот метод открывает файл на чтение, читает по 11 строк и упаковывает эти строки в книги,
-        которые затем отправляются в books
+        которые затем добавляются в словари книг
         """
-        self.books = list()
         with open(self.filename, "r") as file:
             lines = file.readlines()
             for i in range(len(lines)//11):
                 book = list()
                 for j in range(11):
                     book.append(lines[i*11+j][:-1])
-                self.books.append(book)
+                self.__add(book)
+    
+    def __replay_journal(self):
+        """
+        Каждая строка журнала - одно изменение в формате json: ["add", книга],
+        ["edit", название, номер строки, значение] или ["remove", название]
+        Изменения применяются поверх прочитанного файла в том же порядке, в котором вносились
+        Недописанная строка (например, после аварийного завершения) пропускается
+        Если режим журнала выключен или журнал слишком большой, он сразу сливается с файлом
+        """
+        if self.journal_name in os.listdir():
+            with open(self.journal_name, "r") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    match record[0]:
+                        case "add":
+                            self.__add(record[1])
+                        case "edit":
+                            self.__edit(record[1], record[2], record[3])
+                        case "remove":
+                            self.__remove(record[1])
+                    self.__journal_len += 1
+        if self.__journal_len and (not self.journal or self.__journal_len >= self.journal_limit):
+            self.__write_data()
     
     def __write_data(self):
         """
-        При сохранении перезаписывается файл с данными, старые значения в нём удаляются
+        При сохранении данные пишутся во временный файл, который затем заменяет основной,
+        так что при сбое на диске остаётся либо старая, либо новая версия
         Запись производится построчно
+        После сохранения журнал больше не нужен и удаляется
         """
-        with open(self.filename, "w") as file:
-            for book in self.books:
+        with open(self.filename + ".tmp", "w") as file:
+            for book in self.__books.values():
                 for line in book:
                     file.write(line+"\n")
+        os.replace(self.filename + ".tmp", self.filename)
+        if self.__journal_file:
+            self.__journal_file.close()
+            self.__journal_file = None
+        if self.__journal_len:
+            os.remove(self.journal_name)
+            self.__journal_len = 0
+    
+    def __log(self, record: list) -> None:
+        """
+        Принимает описание изменения
+        В режиме журнала дописывает его одной строкой в конец журнала, поэтому цена записи
+        зависит от размера изменения, а не от количества книг
+        Когда журнал дорастает до journal_limit записей, сливает его с файлом
+        Без журнала перезаписывает файл целиком
+        """
+        if not self.journal:
+            self.__write_data()
+            return
+        if not self.__journal_file:
+            self.__journal_file = open(self.journal_name, "a")
+        self.__journal_file.write(json.dumps(record)+"\n")
+        self.__journal_file.flush()
+        self.__journal_len += 1
+        if self.__journal_len >= self.journal_limit:
+            self.__write_data()
+    
+    def compact(self) -> None:
+        """
+        Принудительно сливает журнал с файлом
+        """
+        self.__write_data()
     
     def print_book_list(self) -> None:
         """
         Перебирает все книги в поле books, выводит их на экран нумеруя
         Сообщает об отсуствии книг, если их нет
         """
-        for i, book in enumerate(self.books):
+        for i, book in enumerate(self.__books.values()):
             print(i+1, book[0], sep=". ")
-        if not self.books:
+        if not self.__books:
             print("Книги не добавлены!")
     
     def print_book_data(self, book_name: str) -> None:
@@ -203,53 +286,86 @@ class DBWorker:
         """
         string = string.lower()
         found_books = list()
-        for book in self.books:
+        for book in self.__books.values():
             if string in book[0].lower() or \
                string in book[1].lower() or \
                string in book[2].lower():
                found_books.append(book)
         return found_books
     
+    def __add(self, data: list[str]) -> bool:
+        """
+        Добавляет книгу в словари, если книги с таким названием ещё нет
+        Номер новой книги больше всех предыдущих, поэтому порядок книг сохраняется
+        Файл не трогает, это делает вызывающий метод
+        """
+        if data[0] in self.__titles:
+            return False
+        self.__books[self.__next_id] = data
+        self.__titles[data[0]] = self.__next_id
+        self.__next_id += 1
+        return True
+    
+    def __edit(self, book_name: str, index: int, string: str) -> bool:
+        """
+        Меняет заданную строку книги с точным названием, если такая книга есть
+        При переименовании книга сохраняет свой номер, а значит и место в списке
+        Переименовать книгу в название уже существующей нельзя
+        """
+        book_id = self.__titles.get(book_name)
+        if book_id is None:
+            return False
+        if index == 0 and string != book_name:
+            if string in self.__titles:
+                return False
+            self.__titles[string] = self.__titles.pop(book_name)
+        self.__books[book_id][index] = string
+        return True
+    
+    def __remove(self, book_name: str) -> bool:
+        """
+        Удаляет книгу с точным названием, если такая книга есть
+        """
+        book_id = self.__titles.pop(book_name, None)
+        if book_id is None:
+            return False
+        del self.__books[book_id]
+        return True
+    
     def add_book(self, data: list[str]) -> bool:
         """
         Принимает в себя список корректных значений для внесения в список в книг
         Если книга с таким названием существует, сообщаем о неудаче
-        Иначе добавляем её в список книг и перезаписываем файл, сообщаем об успехе
+        Иначе добавляем её в список книг и сохраняем изменение, сообщаем об успехе
         """
-        for book in self.books:
-            if book[0] == data[0]:
-                return False
-        self.books.append(data)
-        self.__write_data()
+        if not self.__add(data):
+            return False
+        self.__log(["add", data])
         return True
     
     def edit_book(self, book_name: str, index: int, string: str) -> bool:
         """
         Принимает точное название книги, номер строки для изменения и новое значения
         Предполагается, что всё, кроме названия книги, обязано быть корректным
-        Перебирает все книги, и в случае совпадения с названием меняет заданную строку,
-        перезаписывает файл
+        Ищет книгу с таким названием, и в случае совпадения меняет заданную строку,
+        сохраняет изменение
         Если книга не найдена, сообщаем о неудаче
         """
-        for book in self.books:
-            if book_name == book[0]:
-                book[index] = string
-                self.__write_data()
-                return True
-        return False
+        if not self.__edit(book_name, index, string):
+            return False
+        self.__log(["edit", book_name, index, string])
+        return True
     
     def remove_book(self, book_name: str) -> bool:
         """
         Принимает точное название книги
-        Если такая книга существует, удаляет её и перезаписывает файл
+        Если такая книга существует, удаляет её и сохраняет изменение
         Иначе сообщает о неудаче
         """
-        for i, book in enumerate(self.books):
-            if book_name == book[0]:
-                del self.books[i]
-                self.__write_data()
-                return True
-        return False
+        if not self.__remove(book_name):
+            return False
+        self.__log(["remove", book_name])
+        return True
     
     def get_book(self, book_name: str) -> list[str]:
         """
@@ -257,10 +373,7 @@ class DBWorker:
         Если книга существует, возвращает её
         Иначе возвращает пустой список
         """
-        for book in self.books:
-            if book[0] == book_name:
-                return book
-        return []
+        return self.__books.get(self.__titles.get(book_name), [])
 
 
 def main() -> None:
@@ -277,7 +390,7 @@ def main() -> None:
     print("6. Информация о книге")
     print("0. Выход")
 
-    db_worker = DBWorker("books.txt") # Указано название файла с книгами
+    db_worker = DBWorker("books.txt", journal=True) # Указано название файла с книгами
     running = True
     while running:
         print("="*40) # Разделитель между командами
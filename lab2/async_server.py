@@ -0,0 +1,181 @@
+"""
+Асинхронный сервер. Понимает те же команды и работает с тем же DBWorker, что и
+server.py, но вместо потока на каждого клиента обслуживает все подключения в одном
+цикле событий asyncio, поэтому тысячи простаивающих клиентов не превращаются в
+тысячи потоков. Чтение выполняется прямо в цикле: DBWorker отдаёт
+его из памяти. Изменения могут ждать записи на диск, поэтому они уходят в пул потоков.
+Туда же уходит чтение, пока каталог не прогрет: первый поиск строит индекс, а ленивые
+книги дочитываются с диска, и всё это время цикл не обслуживал бы остальных. И
+всегда - полные списки и поиск по строке короче тройки: они перебирают весь каталог
+Запуск: python async_server.py (параметры те же, что у server.py)
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from server import BUSY_RESPONSE, CHUNK_SIZE, CMD_SEP, GRAM_SIZE, HEARTBEAT, IDLE_TIMEOUT, \
+                   PORT, FrameBuffer, Session, Subscription, build_parser, command_opcode, \
+                   create_db_worker, handle_command, log, setup_logging, start_metrics_dump
+
+BACKLOG = 1024             # Сколько подключений может ждать принятия
+WRITE_WORKERS = 64         # Сколько изменений может одновременно ждать записи на диск
+WRITE_COMMANDS = ("3", "4", "5", "7", "8") # Команды, которые пишут на диск
+READ_COMMANDS = ("1", "2", "6", "12", "14", "16") # Команды, которые читают книги целиком
+LIST_COMMANDS = ("1", "13")                # Команды, которые выдают весь каталог
+SEARCH_COMMANDS = ("2", "12", "14")        # Команды поиска, строка - первый аргумент
+MAX_CONNECTIONS = 10000    # Подключение здесь дешевле потока, поэтому их можно больше
+
+
+def scans(command):
+    """
+    Перебирает ли поиск весь каталог: строку короче тройки индекс не ускоряет.
+    Испорченная команда тоже считается долгой, плохим запросом её признает пул
+    """
+    args = command.split(CMD_SEP.encode("utf-8"), 2)
+    return len(args) < 2 or len(args[1].decode("utf-8", "replace")) < GRAM_SIZE
+
+def blocks(command, db_worker):
+    """
+    Может ли команда надолго занять поток: запись ждёт диска, полный список и
+    короткий поиск перебирают весь каталог, а чтение до первого поиска ждёт
+    построения индекса или дочитывания ленивых книг
+    """
+    opcode = command_opcode(command)
+    return opcode in WRITE_COMMANDS or opcode in LIST_COMMANDS or \
+           opcode in SEARCH_COMMANDS and scans(command) or \
+           opcode in READ_COMMANDS and not db_worker.warm
+
+
+async def serve_client(reader, writer, db_worker, executor, idle_timeout=IDLE_TIMEOUT):
+    """
+    Обслуживание одного клиента: читаем запросы, выполняем по порядку, отвечаем и так
+    по кругу, пока клиент не попрощается, не наберёт слишком много плохих запросов
+    или не промолчит дольше idle_timeout секунд.
+    Ответы на запросы, присланные подряд, уходят в том же порядке.
+    После подписки (команда 40) клиенту только отправляются события
+    """
+    loop = asyncio.get_running_loop()
+    session = Session(writer.get_extra_info("peername")[1])
+    frames = FrameBuffer()
+    log.info("%s: соединение установлено", session.port)
+    while session.running:
+        try:
+            data = await asyncio.wait_for(reader.read(CHUNK_SIZE), idle_timeout)
+            commands = frames.feed(data)
+        except asyncio.TimeoutError:
+            log.info("%s: соединение закрыто по простою", session.port)
+            break
+        except (ConnectionError, ValueError):
+            break
+        if not data:
+            log.info("%s: соединение закрыто клиентом", session.port)
+            break
+        for command in commands:
+            blocking = blocks(command, db_worker)
+            if blocking:
+                response = await loop.run_in_executor(executor, handle_command,
+                                                      command, session, db_worker)
+            else:
+                response = handle_command(command, session, db_worker)
+            if isinstance(response, bytes):
+                writer.write(response)
+            elif isinstance(response, Subscription):
+                await push_events(writer, session, response, db_worker)
+                break
+            else:                             # Потоковый ответ: ждём, пока клиент
+                while True:                   # заберёт часть, прежде чем готовить
+                    if blocking:              # следующую. Части долгой команды
+                        chunk = await loop.run_in_executor(executor, next, response, None)
+                    else:                     # тоже готовятся в пуле потоков
+                        chunk = next(response, None)
+                    if chunk is None:
+                        break
+                    writer.write(chunk)
+                    try:
+                        await writer.drain()
+                    except ConnectionError:
+                        session.running = False
+                        break
+            if not session.running:
+                break
+        try:
+            await writer.drain()
+        except ConnectionError:
+            break
+    writer.close()
+
+
+async def push_events(writer, session, subscription, db_worker):
+    """
+    Отправка событий подписчику. DBWorker публикует события из других потоков,
+    поэтому будит цикл событий через call_soon_threadsafe. Пока клиент не забрал
+    прошлую пачку (drain), новые копятся в очереди подписки, а если она
+    переполнилась, клиент получает "resync" и отключается
+    """
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+    subscription.notify = lambda: loop.call_soon_threadsafe(wakeup.set)
+    try:
+        while True:
+            events = subscription.take()
+            if not events and not subscription.overflowed:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), HEARTBEAT)
+                except asyncio.TimeoutError:      # Пустая пачка - знак, что
+                    pass                          # подключение живо
+                wakeup.clear()
+                events = subscription.take()
+            if subscription.overflowed:
+                events.append(["resync", None, None, db_worker.catalogue_version])
+            writer.write(session.pack(events))
+            await writer.drain()
+            if subscription.overflowed:
+                break
+    except ConnectionError:
+        pass
+    finally:
+        db_worker.unsubscribe(subscription)
+        session.running = False
+
+
+async def serve(db_worker, max_connections=MAX_CONNECTIONS, idle_timeout=IDLE_TIMEOUT):
+    executor = ThreadPoolExecutor(max_workers=WRITE_WORKERS)
+    connections = set()
+
+    async def accept(reader, writer):    # Сверх max_connections клиент получает
+        if len(connections) >= max_connections:          # "сервер занят"
+            log.warning("%s: сервер занят, соединение отклонено",
+                        writer.get_extra_info("peername")[1])
+            db_worker.metrics.connection_rejected()
+            writer.write(BUSY_RESPONSE)
+            writer.close()
+            return
+        task = asyncio.current_task()
+        connections.add(task)
+        db_worker.metrics.connection_opened()
+        try:
+            await serve_client(reader, writer, db_worker, executor, idle_timeout)
+        finally:
+            connections.discard(task)
+            db_worker.metrics.connection_closed()
+
+    server = await asyncio.start_server(accept, "localhost", PORT, backlog=BACKLOG)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = build_parser("Асинхронный сервер библиотеки")
+    parser.set_defaults(max_connections=MAX_CONNECTIONS)
+    args = parser.parse_args()
+    listener = setup_logging(args.log_level)
+    db_worker = create_db_worker(args)
+    start_metrics_dump(db_worker, args)
+    try:
+        asyncio.run(serve(db_worker, args.max_connections, args.idle_timeout))
+    except KeyboardInterrupt:              # Дописываем очередь изменений на диск
+        db_worker.close()
+    finally:
+        listener.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+Замеры DBWorker из lab1/main.py и из server.py на каталогах разного размера, без
+сети и без Faker. Каталоги по 10 тысяч, 100 тысяч и миллиону книг того же вида,
+что делает data_generator.py, собираются из случайных слов с постоянным зерном,
+поэтому от запуска к запуску они одинаковые, а название книги вычисляется по её
+номеру. Для каждого размера и каждого DBWorker замеряются загрузка, get_book,
+find_books, add_book, edit_book, remove_book и сохранение (compact), а отдельным
+проходом под tracemalloc - пик памяти каждой операции и память, которую занимает
+загруженный каталог. tracemalloc замедляет всё в разы, поэтому время и память
+меряются разными проходами.
+Оба DBWorker работают в режиме журнала. DBWorker сервера загружается так же, как
+его запускает сервер (лениво), но с durability=sync, чтобы время изменения
+включало запись на диск, а не ожидание групповой записи, и без кэша поиска, иначе
+find_books замерял бы кэш. Первый поиск в server.py строит индекс, поэтому он
+замеряется отдельно как find_first.
+Отчёт печатается таблицей, а с --json пишется в файл. С --baseline отчёт
+сравнивается с прошлым, и если время или память какой-то операции выросли больше
+чем на --tolerance, программа завершается с кодом 1.
+Запуск: python benchmark.py --sizes 10000 100000 --json baseline.json
+"""
+import argparse
+import importlib.util
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from server import DBWorker
+
+LAB1_MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lab1", "main.py")
+SIZES = (10_000, 100_000, 1_000_000)
+TARGETS = ("lab1", "lab2")
+SEED = 0
+OPS = {                    # Сколько раз повторять операцию при замере времени
+    "get_book": 10000,
+    "find_books": 10,
+    "add_book": 500,
+    "edit_book": 500,
+    "remove_book": 500,
+}
+MEMORY_OPS = 10            # и при замере памяти
+TOLERANCE = 0.2            # Допустимое ухудшение относительно --baseline
+WORDS = ("тайна", "город", "ветер", "ночь", "звезда", "река", "дорога", "сердце",
+         "время", "море", "тень", "огонь", "зима", "сад", "песня", "дом", "путь",
+         "мост", "остров", "небо", "лес", "поле", "старый", "последний", "белый",
+         "тихий", "северный", "далёкий", "забытый", "новый", "чужой", "светлый")
+NAMES = ("Иванов", "Петров", "Смирнова", "Кузнецов", "Попова", "Соколов", "Лебедева",
+         "Козлов", "Новикова", "Морозов", "Волкова", "Соловьёв")
+FIRST_NAMES = ("Иван", "Анна", "Пётр", "Мария", "Сергей", "Ольга", "Алексей", "Елена")
+GENRES = ("Фантастика", "Детектив", "Роман", "Научная литература", "История", "Поэзия")
+
+
+def book_title(number):                      # Номер в конце делает названия разными
+    words = (WORDS[number % len(WORDS)], WORDS[number // len(WORDS) % len(WORDS)],
+             WORDS[(number*7 + 3) % len(WORDS)])
+    return " ".join(words).capitalize() + f" {number}"
+
+def generate_book(rng, number):              # Книга того же вида, что у data_generator.py
+    year = rng.randint(1900, 2020)
+    lib_year = year + rng.randint(1, 4)
+    return [
+        book_title(number),                                           # Название
+        rng.choice(GENRES),                                           # Жанр
+        rng.choice(NAMES) + " " + rng.choice(FIRST_NAMES),            # Авторы
+        str(year),                                                    # Год выпуска
+        str(rng.randint(30, 1000)),                                   # Ширина обложки
+        str(rng.randint(30, 1000)),                                   # Высота обложки
+        rng.choice(("мягкий", "твёрдый")),                            # Формат переплёта
+        rng.choice(("покупка", "подарок", "наследство")),             # Источник
+        f"{rng.randint(1, 28)}.{rng.randint(1, 12)}.{lib_year}",      # Появление
+        f"{rng.randint(1, 28)}.{rng.randint(1, 12)}.{lib_year + rng.randint(1, 5)}",
+        str(rng.randint(1, 5)) + " " + " ".join(rng.choices(WORDS, k=6)), # Отзыв
+    ]
+
+def write_catalogue(filename, size):         # В том же формате, что books.txt
+    rng = random.Random(SEED)
+    with open(filename, "w") as file:
+        for number in range(size):
+            file.write("\n".join(generate_book(rng, number)) + "\n")
+
+
+def load_lab1():                             # lab1/main.py - не пакет, грузим по пути
+    spec = importlib.util.spec_from_file_location("lab1_main", LAB1_MAIN)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.DBWorker
+
+def open_worker(target, filename):
+    if target == "lab1":
+        return load_lab1()(filename, journal=True)
+    return DBWorker(filename, journal=True, lazy=True, durability="sync", query_cache=0)
+
+
+def operations(worker, target, size, counts):
+    """
+    Операции в порядке замера: функции без аргументов, каждая выполняет нужное
+    количество вызовов. Аргументы готовятся заранее, чтобы в замер не попало
+    ничего, кроме вызовов DBWorker
+    """
+    rng = random.Random(SEED)
+    titles = [book_title(number) for number in rng.sample(range(size), counts["get_book"])]
+    edited = [book_title(number) for number in rng.sample(range(size), counts["edit_book"])]
+    queries = [rng.choice(WORDS)[:rng.randint(3, 5)] for _ in range(counts["find_books"])]
+    added = [generate_book(rng, size + number) for number in range(counts["add_book"])]
+    removed = [book[0] for book in added[:counts["remove_book"]]]
+    ops = {
+        "get_book": lambda: [worker.get_book(title) for title in titles],
+        "find_books": lambda: [worker.find_books(query) for query in queries],
+        "add_book": lambda: [worker.add_book(book) for book in added],
+        "edit_book": lambda: [worker.edit_book(title, 10, "5 замер") for title in edited],
+        "remove_book": lambda: [worker.remove_book(title) for title in removed],
+        "save": worker.compact,
+    }
+    if target == "lab2":                     # Первый поиск строит индекс
+        ops = {"find_first": lambda: worker.find_books(queries[0]), **ops}
+    return ops
+
+
+def time_pass(target, filename, size):       # Среднее время одного вызова, мкс
+    start = time.perf_counter()
+    worker = open_worker(target, filename)
+    results = {"load": {"ops": 1, "mean_us": round((time.perf_counter() - start) * 1e6)}}
+    for name, run in operations(worker, target, size, OPS).items():
+        count = OPS.get(name, 1)
+        start = time.perf_counter()
+        run()
+        results[name] = {"ops": count,
+                         "mean_us": round((time.perf_counter() - start) / count * 1e6, 1)}
+    return results
+
+def memory_pass(target, filename, size, results):
+    """
+    Пик памяти при загрузке, память загруженного каталога и пик каждой операции
+    сверх того, что было занято до неё, в килобайтах
+    """
+    tracemalloc.start()
+    worker = open_worker(target, filename)
+    current, peak = tracemalloc.get_traced_memory()
+    results["load"].update(peak_kb=peak // 1024, retained_kb=current // 1024)
+    counts = {name: min(count, MEMORY_OPS) for name, count in OPS.items()}
+    for name, run in operations(worker, target, size, counts).items():
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        run()
+        results[name]["peak_kb"] = (tracemalloc.get_traced_memory()[1] - before) // 1024
+    tracemalloc.stop()
+
+def run_benchmark(targets, sizes, memory=True):
+    """
+    Каталоги создаются во временной папке, и каждый проход получает свою копию,
+    потому что замер их меняет. lab1 ищет файл в текущей папке, поэтому замеры
+    идут из временной
+    """
+    report = {target: dict() for target in targets}
+    workdir = tempfile.mkdtemp(prefix="benchmark")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        for size in sizes:
+            write_catalogue("catalogue.txt", size)
+            for target in targets:
+                shutil.copy("catalogue.txt", "books.txt")
+                results = time_pass(target, "books.txt", size)
+                if memory:
+                    shutil.copy("catalogue.txt", "books.txt")
+                    memory_pass(target, "books.txt", size, results)
+                report[target][str(size)] = results
+                print_results(target, size, results)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def print_results(target, size, results):
+    print(f"{target}, {size} книг")
+    print(f"{'операция':>12} {'вызовов':>8} {'мкс на вызов':>13} {'пик, КБ':>10} "
+          f"{'занято, КБ':>11}")
+    for name, result in results.items():
+        print(f"{name:>12} {result['ops']:>8} {result['mean_us']:>13} "
+              f"{result.get('peak_kb', '-'):>10} {result.get('retained_kb', ''):>11}")
+    print()
+
+def compare(report, baseline, tolerance):   # Список ухудшений относительно baseline
+    regressions = list()
+    for target, sizes in report.items():
+        for size, results in sizes.items():
+            for name, result in results.items():
+                old = baseline.get(target, {}).get(size, {}).get(name)
+                if old is None:
+                    continue
+                for key, unit in (("mean_us", "мкс"), ("peak_kb", "КБ"),
+                                  ("retained_kb", "КБ")):
+                    if key in result and key in old and \
+                       result[key] > old[key] * (1 + tolerance):
+                        regressions.append(f"{target}, {size} книг, {name}: {key} "
+                                           f"{result[key]} {unit} против {old[key]} {unit}")
+    return regressions
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Замеры DBWorker на больших каталогах")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES,
+                        help="размеры каталогов в книгах")
+    parser.add_argument("--targets", nargs="+", choices=TARGETS, default=TARGETS,
+                        help="какие DBWorker замерять")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="не замерять память (проход под tracemalloc долгий)")
+    parser.add_argument("--json", help="файл для отчёта в json")
+    parser.add_argument("--baseline", help="отчёт прошлого запуска для сравнения")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="допустимое ухудшение, 0.2 - на 20%%")
+    return parser
+
+def main():
+    args = build_parser().parse_args()
+    if min(args.sizes) < max(OPS.values()):
+        sys.exit(f"Каталог должен быть не меньше {max(OPS.values())} книг")
+    json_file = args.json and os.path.abspath(args.json)
+    baseline_file = args.baseline and os.path.abspath(args.baseline)
+    report = run_benchmark(args.targets, args.sizes, not args.no_memory)
+    if json_file:
+        with open(json_file, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+    if baseline_file:
+        with open(baseline_file, encoding="utf-8") as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        for regression in regressions:
+            print("Ухудшение:", regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
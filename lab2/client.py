@@ -1,12 +1,22 @@
 import re                      # Библиотека для работы с регулярными выражениями
-import json                    # Библиотека, которая умеет упаковывать данные для отправки
 import socket                  # Библиотека для сетевого взаимодействия
+import zlib                    # Библиотека для распаковки сжатых ответов
+from codec import DEFAULT_CODEC, get_codec # Общие с сервером кодеки данных
+from collections import OrderedDict
 from datetime import datetime  # Дата и время
 
 
 CHUNK_SIZE = 4096              # Размер пачки, которую можно отправить и принять разом
 PORT = 9090                    # Порт сервера
 CMD_SEP = "*-*"                # Разделитель в командах, ставится между аргументами
+PIPELINE_DEPTH = 16            # Сколько пачек книг можно отправить, не дождавшись ответа
+PAGE_SIZE = 100                # Размер страницы списка и поиска
+COMPRESSED_FLAG = 1 << 31      # Старший бит размера ответа - признак сжатия
+BUSY_RESPONSE = (0xFFFFFFFF).to_bytes(4, byteorder="big") # Ответ "сервер занят"
+CONFLICT = 2                   # Ответ на изменение книги, которую уже изменил кто-то другой
+NOT_MODIFIED = (0xFFFFFFFE).to_bytes(4, byteorder="big") # Ответ "у вас последняя версия"
+BAD_REQUEST = (0xFFFFFFFD).to_bytes(4, byteorder="big") # Ответ "запрос не понят"
+CACHE_SIZE = 256               # Сколько ответов сервера помнить
 
 
 # Переписанные проверки. Тут используются регулярные выражения
@@ -47,54 +57,266 @@ def correct_date(old_date: str, date):
 def correct_review(review):
     return re.match(r"^[1-5].*$", review)
 
+class ServerBusy(ConnectionError): # Сервер перегружен и отказал в подключении
+    pass
+
+class BadRequest(ValueError): # Сервер не понял запрос, подключение при этом цело
+    pass
+
+# Разбор ответа, общий для Messenger и асинхронного клиента из client_lib.py
+def check_header(header): # Вместо ответа сервер может отказать: занят или не понял
+    if header == BUSY_RESPONSE:
+        raise ServerBusy("сервер занят")
+    if header == BAD_REQUEST:
+        raise BadRequest("сервер не понял запрос")
+
+def data_size(header): # Сколько байт ответа идёт за первыми четырьмя
+    check_header(header)
+    return int.from_bytes(header, byteorder="big") & ~COMPRESSED_FLAG
+
+def unpack_data(header, received_data, codec): # Распаковка того, что за заголовком
+    if int.from_bytes(header, byteorder="big") & COMPRESSED_FLAG:
+        received_data = zlib.decompress(received_data)
+    return codec.decode(received_data) if received_data else []
+
 # Класс для сетевого взаимодействия со стороны клиента. С ним просто удобнее работать
 class Messenger:
-    def __init__(self, addr, port, buf_size, cmd_sep):
+    def __init__(self, addr, port, buf_size, cmd_sep, codec=DEFAULT_CODEC.name,
+                 compression="none"):
         self.sock = socket.socket() # При создании нашего посыльного создаём сокет
         self.sock.connect((addr, port)) # Подключаемся к серверу
         self.__chunk_size = buf_size # Сохраняем параметры для работы
         self.__cmd_sep = cmd_sep
+        self.codec = DEFAULT_CODEC
+        self.compression = "none"
+        self.__cache = OrderedDict() # Запрос -> (версия, ответ), давно нужные вытесняются
+        options = list()             # Другой кодек и сжатие нужно согласовать с
+        if codec != DEFAULT_CODEC.name and get_codec(codec): # сервером. Если он их
+            options.append("codec="+codec)                   # не знает, остаёмся на
+        if compression != "none":                            # json без сжатия
+            options.append("compression="+compression)
+        if options:
+            self.send_command("30", *options)
+            if self.get_bool():
+                self.codec = get_codec(codec) or self.codec
+                self.compression = compression
+    
+    def __recv_exactly(self, size): # Приём ровно size байт, сколько бы recv ни понадобилось
+        received_data = bytearray()
+        while len(received_data) < size:
+            remaining_bytes = size - len(received_data)
+            chunk = self.sock.recv(min(self.__chunk_size, remaining_bytes))
+            if not chunk:
+                raise ConnectionError("сервер закрыл соединение")
+            received_data += chunk
+        return bytes(received_data)
+    
+    def __send(self, message):
+        """
+        Запрос оформляется так же, как ответ сервера: четыре байта размера и сама
+        команда. Поэтому команда может быть любой длины, а несколько команд можно
+        отправить подряд, не дожидаясь ответов - сервер ответит в том же порядке
+        """
+        self.sock.sendall(len(message).to_bytes(4, byteorder="big") + message)
     
     def get_data(self): # Метод получения данных от сервера
         """
         Первым делом получаем число от сервера - количество байт, которое
         он должен отправить
-        Дальше в цикле получаем эти данные до тех пор, пока не заберём все
-        После производим десериализацию из json в понятный питону список
+        Дальше получаем эти данные до тех пор, пока не заберём все. Если в размере
+        поднят старший бит, данные сжаты, и их нужно распаковать
+        После производим десериализацию кодеком подключения (по умолчанию из json)
+        в понятный питону список
+        На условный запрос сервер может ответить, что данные не изменились, тогда
+        возвращается None
         """
-        data_size = int.from_bytes(self.sock.recv(4), byteorder="big")
-        received_data = b""
-        while len(received_data) < data_size:
-            remaining_bytes = data_size - len(received_data)
-            received_data += self.sock.recv(min(self.__chunk_size, remaining_bytes))
-        return json.loads(received_data) if received_data else []
+        header = self.__recv_exactly(4)
+        if header == NOT_MODIFIED:
+            return None
+        return unpack_data(header, self.__recv_exactly(data_size(header)), self.codec)
     
     def get_bool(self): # Метод получения результата от сервера: да или нет
-        return int.from_bytes(self.sock.recv(self.__chunk_size)) # 1 в случае успеха и 0 при неудаче
+        result = self.__recv_exactly(1)
+        if result == BUSY_RESPONSE[:1]: # Так начинаются и "занят", и "не понял"
+            check_header(result + self.__recv_exactly(3))
+        return int.from_bytes(result) # 1 в случае успеха и 0 при неудаче
+    
+    def ping(self): # Пустое рукопожатие: проверка, что сервер принял подключение
+        self.send_command("30")
+        return self.get_bool()
     
     def send_command(self, command, *args): # Метод отправки команды с аргументами
         try: # Пытаемся отправить номер команды и аргументы с разделителем
             message = self.__cmd_sep.join([command]+list(args))
-            self.sock.send(message.encode("utf-8"))
+            self.__send(message.encode("utf-8"))
             return True # Если получилось, возвращаем успех
         except:
             return False # Иначе неудачу
     
     def send_data(self, command, data):
         """
-        Метод отправки малых данных на сервер (не больше одной почки)
+        Метод отправки данных на сервер
         """
         try:
-            message = self.__cmd_sep.join([command, json.dumps(data)])
-            self.sock.send(message.encode("utf-8"))
+            message = (command+self.__cmd_sep).encode("utf-8") + self.codec.encode(data)
+            self.__send(message)
             return True
         except:
             return False
+    
+    def add_books(self, books):
+        """
+        Массовое добавление книг. Книги отправляются командой 7 пачками размером около
+        почки, поэтому на тысячу книг уходит несколько запросов вместо тысячи. Пачки
+        идут подряд, не дожидаясь ответов, но не больше PIPELINE_DEPTH без ответа.
+        Возвращает количество принятых и отклонённых книг
+        """
+        accepted = rejected = in_flight = 0
+        for batch in self.__batches(books):
+            self.send_data("7", batch)
+            in_flight += 1
+            if in_flight == PIPELINE_DEPTH:
+                added, skipped = self.get_data()
+                accepted, rejected = accepted+added, rejected+skipped
+                in_flight -= 1
+        for _ in range(in_flight):
+            added, skipped = self.get_data()
+            accepted, rejected = accepted+added, rejected+skipped
+        return accepted, rejected
+    
+    def __cached(self, command, *args):
+        """
+        Условный запрос: к команде добавляется версия уже полученного ответа, и если
+        на сервере ничего не поменялось, он отвечает четырьмя байтами, а ответ берётся
+        из кэша. Версия каталога меняется при любом изменении, поэтому список и поиск
+        всегда свежие, а у книги версия своя. Ответы из кэша общие, их нельзя изменять
+        """
+        key = (command, *args)
+        version, data = self.__cache.get(key, (None, None))
+        self.send_command(command, *args, "" if version is None else str(version))
+        response = self.get_data()
+        if response is not None:
+            data, version = response
+            if version is None:          # Книги нет, помнить нечего
+                self.__cache.pop(key, None)
+                return data
+            self.__cache[key] = (version, data)
+            if len(self.__cache) > CACHE_SIZE:
+                self.__cache.popitem(last=False)
+        self.__cache.move_to_end(key)
+        return data
+    
+    def get_book_list(self): # Названия всех книг (команда 1)
+        return self.__cached("1")
+    
+    def find_books(self, string): # Книги, где string есть в названии, жанре или авторах
+        return self.__cached("2", string)
+    
+    def get_book(self, book_name): # Книга или пустой список, если её нет
+        return self.__cached("6", book_name)
+    
+    def add_book(self, book): # False, если книга с таким названием уже есть
+        self.send_data("3", book)
+        return bool(self.get_bool())
+    
+    def get_book_version(self, book_name):
+        """
+        Книга и её версия (команда 16). Версию можно передать в edit_book и
+        remove_book: если книгу с тех пор кто-то изменил, сервер ответит CONFLICT
+        """
+        self.send_command("16", book_name)
+        book, version = self.get_data()
+        return book, version
+    
+    def edit_book(self, book_name, index, value, version=None): # 1, 0 или CONFLICT
+        self.send_command("4", book_name, str(index), value,
+                          "" if version is None else str(version))
+        return self.get_bool()
+    
+    def remove_book(self, book_name, version=None):
+        self.send_command("5", book_name, "" if version is None else str(version))
+        return self.get_bool()
+    
+    def get_book_page(self, cursor=None, limit=PAGE_SIZE):
+        """
+        Страница списка названий (команда 11). Возвращает названия и курсор, который
+        нужно передать за следующей страницей, или None, если страница последняя
+        """
+        self.send_command("11", "" if cursor is None else str(cursor), str(limit))
+        books, cursor = self.get_data()
+        return books, cursor
+    
+    def find_books_page(self, string, cursor=None, limit=PAGE_SIZE): # Команда 12
+        self.send_command("12", string, "" if cursor is None else str(cursor), str(limit))
+        books, cursor = self.get_data()
+        return books, cursor
+    
+    def iter_book_list(self):
+        """
+        Весь список названий потоком (команда 13): сервер шлёт его частями, а
+        генератор отдаёт названия по одному, как только пришла их часть. Пока
+        генератор не дочитан до конца, другие команды отправлять нельзя
+        """
+        self.send_command("13")
+        yield from self.__stream()
+    
+    def iter_found_books(self, string): # Результаты поиска потоком (команда 14)
+        self.send_command("14", string)
+        yield from self.__stream()
+    
+    def __stream(self):                 # Части идут до пустой
+        while chunk := self.get_data():
+            yield from chunk
+    
+    def get_metrics(self): # Счётчики сервера (команда 19), времена в микросекундах
+        self.send_command("19")
+        return self.get_data()
 
+    def subscribe(self):
+        """
+        Изменения каталога по мере появления (команда 40). Первое событие -
+        ["subscribed", None, None, версия], дальше ["add" | "edit" | "remove",
+        название, номер поля, версия], у переименования в конце старое название.
+        Заканчивается событием "resync": клиент не успевал забирать события, и
+        каталог нужно перечитать. Другие команды на этом подключении больше не
+        выполняются
+        """
+        self.send_command("40")
+        while True:
+            for event in self.get_data():    # Пустая пачка - знак, что сервер жив
+                yield event
+                if event[0] == "resync":
+                    return
+
+    def batch(self, ops, atomic=False):
+        """
+        Несколько операций за один запрос (команда 8): ["get", название],
+        ["find", строка], ["add", книга], ["edit", название, номер поля, значение],
+        ["remove", название]. Возвращает список результатов в том же порядке.
+        С atomic изменения применяются все вместе или не применяются вовсе
+        """
+        self.send_data("8", {"ops": ops, "atomic": atomic})
+        return self.get_data()
+    
+    def __batches(self, books):
+        batch, size = list(), len(self.__cmd_sep) + 3  # Команда, разделитель и скобки
+        for book in books:
+            book_size = len(self.codec.encode(book)) + 2 # С разделителем ", "
+            if batch and size + book_size > self.__chunk_size:
+                yield batch
+                batch, size = list(), len(self.__cmd_sep) + 3
+            batch.append(book)
+            size += book_size
+        if batch:
+            yield batch
 
 def main(): # Главная функция
     try: # Пытаемся подключиться к серверу
         messenger = Messenger("localhost", PORT, CHUNK_SIZE, CMD_SEP)
+        messenger.ping() # Перегруженный сервер отвечает отказом сразу
+    except ServerBusy:
+        print("Сервер занят. Попробуйте позже")
+        return
     except: # При неудаче сообщаем об этом, завершаем выполнение
         print("Сервер недоступен. Завершение работы")
         return
@@ -115,139 +337,121 @@ def main(): # Главная функция
         while not (inp := input("Команда: ")): pass
         match inp: # Обработка команд по смыслу не изменилась, только теперь они
                    # отправляются на сервер вместо db_worker'а
-            case "1":
-                messenger.send_command("1")
-                book_list = messenger.get_data()
-                for i, book_name in enumerate(book_list):
+            case "1": # Повторный список без изменений на сервере берётся из кэша
+                for i, book_name in enumerate(messenger.get_book_list()):
                     print(i+1, book_name, sep=". ")
             case "2":
                 search_string = input("Название, жанр или автор: ")
-                messenger.send_command("2", search_string)
-                if books := messenger.get_data():
+                if books := messenger.find_books(search_string):
                     print("Найденные совпадения:")
                     for i, book in enumerate(books):
                         print(i+1, book[0], sep=". ")
                 else:
                     print("Ничего не найдено!")
             case "3":
-                messenger.send_command("10") # Перед работой с данными блокируем подключение на себя
-                if messenger.get_bool():
-                    data = ["" for i in range(11)]
-                    temp = ""
-                    while not correct_book_name(temp := input("Название книги: ")):
-                        print("Некорректный ввод!")
-                    data[0] = temp
-                    while not correct_authors(temp := input("Авторы: ")):
-                        print("Некорректный ввод!")
-                    data[1] = temp
-                    while not correct_genre(temp := input("Жанр: ")):
-                        print("Некорректный ввод!")
-                    data[2] = temp
-                    while not correct_year(temp := input("Год выпуска: ")):
-                        print("Некорректный ввод!")
-                    data[3] = temp
-                    while not correct_size(temp := input("Ширина обложки: ")):
-                        print("Некорректный ввод!")
-                    data[4] = temp
-                    while not correct_size(temp := input("Высота обложки: ")):
-                        print("Некорректный ввод!")
-                    data[5] = temp
-                    while not correct_binding(temp := input("Формат переплёта(мягкий, твёрдый): ")):
-                        print("Некорректный ввод!")
-                    data[6] = temp
-                    while not correct_source(temp := input("Источник(покупка, подарок, наследство): ")):
-                        print("Некорректный ввод!")
-                    data[7] = temp
-                    while not correct_date("01.01."+data[3], temp := input("Дата появления в библиотеке(ДД.ММ.ГГГГ): ")):
-                        print("Некорректный ввод!")
-                    data[8] = temp
-                    while not correct_date(data[8], temp := input("Дата прочтения(ДД.ММ.ГГГГ): ")):
-                        print("Некорректный ввод!")
-                    data[9] = temp
-                    while not correct_review(temp := input("Оценка с комментарием: ")):
-                        print("Некорректный ввод!")
-                    data[10] = temp
-                    messenger.send_command("20") # Перед отправкой данных разблокируем подключение
-                    messenger.send_data("3", data)
-                    if messenger.get_bool():
-                        print(f"Книга '{data[0]}' добавлена успешно!")
-                    else:
-                        print("Книга с таким названием уже существует!")
+                data = ["" for i in range(11)]
+                temp = ""
+                while not correct_book_name(temp := input("Название книги: ")):
+                    print("Некорректный ввод!")
+                data[0] = temp
+                while not correct_authors(temp := input("Авторы: ")):
+                    print("Некорректный ввод!")
+                data[1] = temp
+                while not correct_genre(temp := input("Жанр: ")):
+                    print("Некорректный ввод!")
+                data[2] = temp
+                while not correct_year(temp := input("Год выпуска: ")):
+                    print("Некорректный ввод!")
+                data[3] = temp
+                while not correct_size(temp := input("Ширина обложки: ")):
+                    print("Некорректный ввод!")
+                data[4] = temp
+                while not correct_size(temp := input("Высота обложки: ")):
+                    print("Некорректный ввод!")
+                data[5] = temp
+                while not correct_binding(temp := input("Формат переплёта(мягкий, твёрдый): ")):
+                    print("Некорректный ввод!")
+                data[6] = temp
+                while not correct_source(temp := input("Источник(покупка, подарок, наследство): ")):
+                    print("Некорректный ввод!")
+                data[7] = temp
+                while not correct_date("01.01."+data[3], temp := input("Дата появления в библиотеке(ДД.ММ.ГГГГ): ")):
+                    print("Некорректный ввод!")
+                data[8] = temp
+                while not correct_date(data[8], temp := input("Дата прочтения(ДД.ММ.ГГГГ): ")):
+                    print("Некорректный ввод!")
+                data[9] = temp
+                while not correct_review(temp := input("Оценка с комментарием: ")):
+                    print("Некорректный ввод!")
+                data[10] = temp
+                if messenger.add_book(data):
+                    print(f"Книга '{data[0]}' добавлена успешно!")
                 else:
-                    print("Подключение заблокировано")
-            case "4":
-                messenger.send_command("10")
-                if messenger.get_bool():
-                    while True:
-                        book_name = input("Точное название книги: ")
-                        messenger.send_command("6", book_name)
-                        if book := messenger.get_data():
-                            break
-                        print("Совпадений не найдено!")
-                    print("1. Название книги")
-                    print("2. Авторы")
-                    print("3. Жанр")
-                    print("4. Год выпуска")
-                    print("5. Ширина обложки")
-                    print("6. Высота обложки")
-                    print("7. Формат переплёта")
-                    print("8. Источник появления")
-                    print("9. Дата появления в библиотеке")
-                    print("10. Дата прочтения")
-                    print("11. Оценка с комментарием")
-                    index = 0
-                    while not (1 <= index <= 11):
-                        try:
-                            index = int(input("Что изменить(число): "))
-                        except: pass
-                    while True:
-                        string = input("Новое значение: ")
-                        if index == 1 and correct_book_name(string):
-                            break
-                        if index == 2 and correct_authors(string):
-                            break
-                        if index == 3 and correct_genre(string):
-                            break
-                        if index == 4 and correct_year(string):
-                            break
-                        if index in (5, 6) and correct_size(string):
-                            break
-                        if index == 7 and correct_binding(string):
-                            break
-                        if index == 8 and correct_source(string):
-                            break
-                        if index == 9 and correct_date("01.01."+book[3], string) and \
-                                        correct_date(string, book[9]):
-                            break
-                        if index == 10 and correct_date(book[8], string):
-                            break
-                        if index == 11 and correct_review(string):
-                            break
-                        print("Некорректное значение")
-                    messenger.send_command("20")
-                    messenger.send_command("4", book_name, str(index-1), string)
-                    if messenger.get_bool():
-                        print("Изменения внесены успешно!")
-                    else:
-                        print("Книга с таким названием не найдена!")
+                    print("Книга с таким названием уже существует!")
+            case "4": # Книга читается вместе с версией. Если пока мы вводим данные,
+                  # её изменит кто-то другой, сервер откажет, и никто никого не ждёт
+                while True:
+                    book_name = input("Точное название книги: ")
+                    book, version = messenger.get_book_version(book_name)
+                    if book:
+                        break
+                    print("Совпадений не найдено!")
+                print("1. Название книги")
+                print("2. Авторы")
+                print("3. Жанр")
+                print("4. Год выпуска")
+                print("5. Ширина обложки")
+                print("6. Высота обложки")
+                print("7. Формат переплёта")
+                print("8. Источник появления")
+                print("9. Дата появления в библиотеке")
+                print("10. Дата прочтения")
+                print("11. Оценка с комментарием")
+                index = 0
+                while not (1 <= index <= 11):
+                    try:
+                        index = int(input("Что изменить(число): "))
+                    except: pass
+                while True:
+                    string = input("Новое значение: ")
+                    if index == 1 and correct_book_name(string):
+                        break
+                    if index == 2 and correct_authors(string):
+                        break
+                    if index == 3 and correct_genre(string):
+                        break
+                    if index == 4 and correct_year(string):
+                        break
+                    if index in (5, 6) and correct_size(string):
+                        break
+                    if index == 7 and correct_binding(string):
+                        break
+                    if index == 8 and correct_source(string):
+                        break
+                    if index == 9 and correct_date("01.01."+book[3], string) and \
+                                    correct_date(string, book[9]):
+                        break
+                    if index == 10 and correct_date(book[8], string):
+                        break
+                    if index == 11 and correct_review(string):
+                        break
+                    print("Некорректное значение")
+                result = messenger.edit_book(book_name, index-1, string, version)
+                if result == CONFLICT:
+                    print("Книгу уже изменили, прочитайте её заново!")
+                elif result:
+                    print("Изменения внесены успешно!")
                 else:
-                    print("Подключение заблокировано")
+                    print("Книга с таким названием не найдена!")
             case "5":
-                messenger.send_command("10")
-                if messenger.get_bool():
-                    book_name = input("Точное название книги: ")
-                    messenger.send_command("20")
-                    messenger.send_command("5", book_name)
-                    if messenger.get_bool():
-                        print(f"Книга '{book_name}' удалена успешно")
-                    else:
-                        print(f"Книга '{book_name}' не найдена")
+                book_name = input("Точное название книги: ")
+                if messenger.remove_book(book_name):
+                    print(f"Книга '{book_name}' удалена успешно")
                 else:
-                    print("Подключение заблокировано")
+                    print(f"Книга '{book_name}' не найдена")
             case "6":
                 book_name = input("Точное название книги: ")
-                messenger.send_command("6", book_name)
-                if book := messenger.get_data():
+                if book := messenger.get_book(book_name):
                     print(f"Название: {book[0]}")
                     print(f"Авторы: {book[1]}")
                     print(f"Жанр: {book[2]}")
@@ -0,0 +1,308 @@
+"""
+Клиентская библиотека для программ, которым нужно много запросов одновременно:
+- MessengerPool - пул подключений Messenger для потоков. Каждый запрос берёт
+  свободное подключение, а если свободных нет и пул ещё не полон, открывает новое
+- AsyncMessenger - клиент для asyncio. Запросы идут по одному подключению подряд,
+  не дожидаясь ответов (сервер отвечает в том же порядке), поэтому в полёте их
+  может быть много
+У обоих те же методы, что и у Messenger в консольном клиенте: get_book_list,
+find_books, get_book, get_book_version, add_book, edit_book и remove_book.
+У каждого запроса есть время ожидания ответа. Если подключение оборвалось, оно
+открывается заново, а запрос повторяется, но изменения повторяются, только если
+не успели уйти на сервер, чтобы одно изменение не применилось дважды
+Пример:
+    pool = MessengerPool()
+    books = pool.find_books("Роман")
+    async with AsyncMessenger() as messenger:
+        books = await asyncio.gather(*(messenger.get_book(t) for t in titles))
+"""
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+from codec import DEFAULT_CODEC, get_codec
+from client import BUSY_RESPONSE, CHUNK_SIZE, CMD_SEP, PORT, BadRequest, Messenger, \
+                   ServerBusy, check_header, data_size, unpack_data
+
+HOST = "localhost"
+POOL_SIZE = 8              # Сколько подключений может открыть пул
+TIMEOUT = 10               # Сколько секунд ждать ответа на запрос
+RETRIES = 2                # Сколько раз повторять запрос после обрыва подключения
+RETRY_DELAY = 0.1          # Пауза перед первым повтором, дальше она удваивается
+MAX_IDLE = 60              # Подключение, которое простояло дольше, открывается заново:
+                           # сервер мог закрыть его по простою
+MAX_IN_FLIGHT = 64         # Сколько запросов AsyncMessenger может ждать ответа разом
+
+
+class MessengerPool:
+    """
+    Потокобезопасный пул подключений. Свободные подключения лежат стопкой, и
+    запрос берёт то, которым пользовались последним. Подключение, на котором
+    случилась ошибка, закрывается, а не возвращается в пул: в нём может остаться
+    недочитанный ответ
+    """
+    def __init__(self, addr=HOST, port=PORT, size=POOL_SIZE, timeout=TIMEOUT,
+                 retries=RETRIES, codec=DEFAULT_CODEC.name, compression="none"):
+        self.addr, self.port = addr, port
+        self.timeout = timeout
+        self.retries = retries
+        self.codec, self.compression = codec, compression
+        self.__free = list()                      # Пары (подключение, когда освободилось)
+        self.__lock = threading.Lock()
+        self.__slots = threading.BoundedSemaphore(size)
+
+    def __take(self):
+        with self.__lock:
+            while self.__free:
+                messenger, released = self.__free.pop()
+                if time.monotonic() - released < MAX_IDLE:
+                    return messenger
+                messenger.sock.close()
+        return Messenger(self.addr, self.port, CHUNK_SIZE, CMD_SEP, self.codec,
+                         self.compression)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Подключение на время блока with. Если все подключения заняты, ждёт
+        освобождения не дольше timeout
+        """
+        timeout = self.timeout if timeout is None else timeout
+        if not self.__slots.acquire(timeout=timeout):
+            raise TimeoutError("все подключения пула заняты")
+        messenger = None
+        try:
+            messenger = self.__take()
+            messenger.sock.settimeout(timeout)
+            yield messenger
+        except BaseException:
+            if messenger is not None:
+                messenger.sock.close()
+                messenger = None
+            raise
+        finally:
+            if messenger is not None:
+                with self.__lock:
+                    self.__free.append((messenger, time.monotonic()))
+            self.__slots.release()
+
+    def __call(self, method, *args, idempotent=True, timeout=None):
+        for attempt in range(self.retries + 1):
+            sent = False
+            try:
+                with self.connection(timeout) as messenger:
+                    sent = True
+                    return getattr(messenger, method)(*args)
+            except TimeoutError:                  # Сервер жив, но не успел ответить
+                raise
+            except OSError:                       # Обрыв, отказ в подключении, "занят"
+                if (sent and not idempotent) or attempt == self.retries:
+                    raise
+            time.sleep(RETRY_DELAY * 2**attempt)
+
+    def get_book_list(self, timeout=None):
+        return self.__call("get_book_list", timeout=timeout)
+
+    def find_books(self, string, timeout=None):
+        return self.__call("find_books", string, timeout=timeout)
+
+    def get_book(self, book_name, timeout=None):
+        return self.__call("get_book", book_name, timeout=timeout)
+
+    def get_book_version(self, book_name, timeout=None):
+        return self.__call("get_book_version", book_name, timeout=timeout)
+
+    def add_book(self, book, timeout=None):
+        return self.__call("add_book", book, idempotent=False, timeout=timeout)
+
+    def edit_book(self, book_name, index, value, version=None, timeout=None):
+        return self.__call("edit_book", book_name, index, value, version,
+                           idempotent=False, timeout=timeout)
+
+    def remove_book(self, book_name, version=None, timeout=None):
+        return self.__call("remove_book", book_name, version, idempotent=False,
+                           timeout=timeout)
+
+    def close(self):                              # Прощаемся со всеми свободными
+        with self.__lock:
+            free, self.__free = self.__free, list()
+        for messenger, _ in free:
+            messenger.send_command("0")
+            messenger.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class AsyncMessenger:
+    """
+    Асинхронный клиент. Запросы записываются в сокет сразу, а их ожидания встают в
+    очередь в том же порядке. Отдельная задача читает ответы по очереди и отдаёт
+    каждый своему ожиданию. Отменённый запрос из очереди не удаляется: его ответ
+    будет прочитан и выброшен, и следующие ответы не перепутаются. Если же ответ
+    не пришёл вовремя, он мог и вовсе потеряться, поэтому подключение закрывается,
+    как в MessengerPool. При обрыве все ожидающие запросы получают ConnectionError
+    (запросы на чтение повторяются), а следующий запрос подключается заново
+    """
+    def __init__(self, addr=HOST, port=PORT, timeout=TIMEOUT, retries=RETRIES,
+                 codec=DEFAULT_CODEC.name, compression="none",
+                 max_in_flight=MAX_IN_FLIGHT):
+        self.addr, self.port = addr, port
+        self.timeout = timeout
+        self.retries = retries
+        self.options = list()                     # Параметры рукопожатия
+        if codec != DEFAULT_CODEC.name and get_codec(codec):
+            self.options.append("codec="+codec)
+        if compression != "none":
+            self.options.append("compression="+compression)
+        self.__codec = get_codec(codec) or DEFAULT_CODEC
+        self.codec = DEFAULT_CODEC                # Кодек, о котором договорились
+        self.__writer = None
+        self.__waiting = None                     # Очередь (вид ответа, ожидание)
+        self.__reading = None                     # Задача, которая читает ответы
+        self.__connecting = asyncio.Lock()
+        self.__slots = asyncio.Semaphore(max_in_flight)
+
+    async def __connect(self):
+        async with self.__connecting:
+            if self.__writer is not None:
+                return
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(self.addr, self.port), self.timeout)
+            self.codec = DEFAULT_CODEC
+            if self.options:
+                writer.write(self.__frame("30", self.options))
+                if await asyncio.wait_for(self.__read_bool(reader), self.timeout):
+                    self.codec = self.__codec
+            self.__writer = writer
+            self.__waiting = asyncio.Queue()
+            self.__reading = asyncio.create_task(self.__read_responses(reader,
+                                                                       self.__waiting))
+
+    def __frame(self, command, args=(), data=None):
+        if data is not None:
+            message = (command+CMD_SEP).encode("utf-8") + self.codec.encode(data)
+        else:
+            message = CMD_SEP.join([command, *args]).encode("utf-8")
+        return len(message).to_bytes(4, byteorder="big") + message
+
+    @staticmethod
+    async def __read_bool(reader):
+        result = await reader.readexactly(1)
+        if result == BUSY_RESPONSE[:1]:           # Так начинаются и "занят", и "не понял"
+            check_header(result + await reader.readexactly(3))
+        return int.from_bytes(result)
+
+    async def __read_data(self, reader):
+        header = await reader.readexactly(4)
+        return unpack_data(header, await reader.readexactly(data_size(header)), self.codec)
+
+    async def __read_responses(self, reader, waiting):
+        future = None
+        try:
+            while True:
+                kind, future = await waiting.get()
+                try:
+                    if kind == "bool":
+                        result = await self.__read_bool(reader)
+                    else:
+                        result = await self.__read_data(reader)
+                except BadRequest as e:           # Отказ - тоже ответ, подключение цело
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                if not future.done():             # Не дождавшиеся ответа уже отменены
+                    future.set_result(result)
+        except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+            error = e if isinstance(e, ConnectionError) else \
+                    ConnectionError(f"подключение оборвалось: {e!r}")
+            self.__disconnect(error, future, waiting)
+        except asyncio.CancelledError:            # Подключение закрыли, пока читался
+            if future is not None and not future.done(): # ответ для future
+                future.set_exception(ConnectionError("подключение закрыто"))
+            raise
+
+    def __disconnect(self, error, future, waiting):
+        if self.__waiting is waiting:             # Подключение ещё не заменили новым
+            self.__writer.close()
+            self.__writer = self.__waiting = None
+        while True:
+            if future is not None and not future.done():
+                future.set_exception(error)
+            if waiting.empty():
+                break
+            _, future = waiting.get_nowait()
+
+    async def __request(self, kind, frame_args, idempotent=True, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        for attempt in range(self.retries + 1):
+            sent = False
+            waiting = None
+            try:
+                async with self.__slots:
+                    await self.__connect()
+                    waiting = self.__waiting
+                    future = asyncio.get_running_loop().create_future()
+                    waiting.put_nowait((kind, future))             # Очередь и сокет без
+                    self.__writer.write(self.__frame(*frame_args)) # await между ними,
+                    sent = True                                    # порядок не нарушится
+                    await self.__writer.drain()
+                    return await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                if waiting is not None and waiting is self.__waiting:
+                    self.__reading.cancel()
+                    self.__disconnect(ConnectionError("подключение закрыто: "
+                                                      "ответ не пришёл вовремя"),
+                                      None, waiting)
+                raise TimeoutError("сервер не ответил вовремя")
+            except OSError:
+                if (sent and not idempotent) or attempt == self.retries:
+                    raise
+            await asyncio.sleep(RETRY_DELAY * 2**attempt)
+
+    async def get_book_list(self, timeout=None):
+        return await self.__request("data", ("1",), timeout=timeout)
+
+    async def find_books(self, string, timeout=None):
+        return await self.__request("data", ("2", [string]), timeout=timeout)
+
+    async def get_book(self, book_name, timeout=None):
+        return await self.__request("data", ("6", [book_name]), timeout=timeout)
+
+    async def get_book_version(self, book_name, timeout=None):
+        book, version = await self.__request("data", ("16", [book_name]), timeout=timeout)
+        return book, version
+
+    async def add_book(self, book, timeout=None):
+        return bool(await self.__request("bool", ("3", (), book), idempotent=False,
+                                         timeout=timeout))
+
+    async def edit_book(self, book_name, index, value, version=None, timeout=None):
+        args = [book_name, str(index), value, "" if version is None else str(version)]
+        return await self.__request("bool", ("4", args), idempotent=False,
+                                    timeout=timeout)
+
+    async def remove_book(self, book_name, version=None, timeout=None):
+        args = [book_name, "" if version is None else str(version)]
+        return await self.__request("bool", ("5", args), idempotent=False,
+                                    timeout=timeout)
+
+    async def close(self):
+        if self.__writer is not None:
+            writer, self.__writer, self.__waiting = self.__writer, None, None
+            writer.write(self.__frame("0"))
+            writer.close()
+            self.__reading.cancel()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -0,0 +1,157 @@
+"""
+Кодеки, которыми сервер и клиент упаковывают данные: JSON (по умолчанию) и
+компактный двоичный. Кодек выбирается для каждого подключения рукопожатием
+(команда 30), поэтому старые клиенты, которые о нём не знают, работают с JSON.
+
+Двоичный формат - значение с однобайтовым тегом в начале:
+- N, T, F - None, True, False
+- I - целое, 8 байт
+- S - строка: длина в байтах (4 байта) и UTF-8
+- L - список: количество (4 байта) и сами значения со своими тегами
+- D - словарь: количество пар и пары ключ-значение
+- W - список строк: количество, длины всех строк в символах и длина в байтах
+  общего куска (по 4 байта), а за ними все строки одним куском UTF-8
+- R - список книг из BOOK_SIZE строк: то же, что W, только количество - книг.
+  Названия и книги, из которых состоят почти все ответы, кодируются одним
+  join и одним encode без тега на каждое поле, а разбираются одним decode
+  и срезами строки
+Все числа - big-endian, как и размер ответа
+"""
+import json
+import struct
+from itertools import accumulate
+
+
+BOOK_SIZE = 11             # Количество полей книги
+
+
+class JSONCodec:
+    name = "json"
+
+    def encode(self, data):
+        return json.dumps(data).encode("utf-8")
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+
+class BinaryCodec:
+    name = "binary"
+
+    def encode(self, data):
+        parts = list()
+        self.__encode(data, parts)
+        return b"".join(parts)
+
+    def decode(self, payload):
+        try:
+            value, pos = self.__decode(memoryview(payload), 0)
+        except struct.error:                      # Данные оборвались на середине
+            raise ValueError("обрезанное значение")
+        if pos != len(payload):
+            raise ValueError("лишние байты после значения")
+        return value
+
+    @staticmethod
+    def __strings(tag, count, strings, parts): # Таблица строк для тегов W и R
+        try:
+            text = "".join(strings)
+        except TypeError:                         # Среди значений не только строки
+            return False
+        blob = text.encode("utf-8", "surrogatepass")
+        parts.append(tag + struct.pack(f">I{len(strings)}II", count,
+                                       *map(len, strings), len(blob)))
+        parts.append(blob)
+        return True
+
+    def __encode(self, value, parts):
+        if value is None:
+            parts.append(b"N")
+        elif value is True:
+            parts.append(b"T")
+        elif value is False:
+            parts.append(b"F")
+        elif isinstance(value, int):
+            parts.append(b"I" + struct.pack(">q", value))
+        elif isinstance(value, str):
+            data = value.encode("utf-8", "surrogatepass")
+            parts.append(b"S" + struct.pack(">I", len(data)) + data)
+        elif isinstance(value, dict):
+            parts.append(b"D" + struct.pack(">I", len(value)))
+            for key, item in value.items():
+                self.__encode(key, parts)
+                self.__encode(item, parts)
+        elif isinstance(value, (list, tuple)):
+            if value and all(isinstance(book, list) and len(book) == BOOK_SIZE
+                             for book in value):
+                fields = [field for book in value for field in book]
+                if self.__strings(b"R", len(value), fields, parts):
+                    return
+            elif value and self.__strings(b"W", len(value), value, parts):
+                return
+            parts.append(b"L" + struct.pack(">I", len(value)))
+            for item in value:
+                self.__encode(item, parts)
+        else:
+            raise TypeError(f"нельзя закодировать {type(value).__name__}")
+
+    @staticmethod
+    def __unpack_strings(buf, pos, size):
+        lengths = struct.unpack_from(f">{size}I", buf, pos)
+        pos += 4*size
+        blob_size, = struct.unpack_from(">I", buf, pos)
+        pos += 4
+        if pos + blob_size > len(buf):
+            raise ValueError("обрезанная таблица строк")
+        text = bytes(buf[pos:pos+blob_size]).decode("utf-8", "surrogatepass")
+        ends = list(accumulate(lengths))
+        if ends and ends[-1] != len(text):
+            raise ValueError("длины строк не сходятся")
+        strings = [text[start:end] for start, end in zip([0]+ends, ends)]
+        return strings, pos + blob_size
+
+    def __decode(self, buf, pos):
+        tag, pos = buf[pos:pos+1].tobytes(), pos+1
+        if tag == b"N":
+            return None, pos
+        if tag == b"T":
+            return True, pos
+        if tag == b"F":
+            return False, pos
+        if tag == b"I":
+            return struct.unpack_from(">q", buf, pos)[0], pos+8
+        if tag == b"S":
+            size, = struct.unpack_from(">I", buf, pos)
+            if pos + 4 + size > len(buf):
+                raise ValueError("обрезанная строка")
+            return bytes(buf[pos+4:pos+4+size]).decode("utf-8", "surrogatepass"), \
+                   pos+4+size
+        count, = struct.unpack_from(">I", buf, pos)
+        pos += 4
+        if tag == b"W":
+            return self.__unpack_strings(buf, pos, count)
+        if tag == b"R":
+            fields, pos = self.__unpack_strings(buf, pos, count*BOOK_SIZE)
+            return [fields[i:i+BOOK_SIZE]
+                    for i in range(0, len(fields), BOOK_SIZE)], pos
+        if tag == b"L":
+            items = list()
+            for _ in range(count):
+                item, pos = self.__decode(buf, pos)
+                items.append(item)
+            return items, pos
+        if tag == b"D":
+            items = dict()
+            for _ in range(count):
+                key, pos = self.__decode(buf, pos)
+                items[key], pos = self.__decode(buf, pos)
+            return items, pos
+        raise ValueError("неизвестный тег")
+
+
+CODECS = {codec.name: codec for codec in (JSONCodec(), BinaryCodec())}
+DEFAULT_CODEC = CODECS["json"]
+
+
+def get_codec(name):                       # None, если такого кодека нет
+    return CODECS.get(name)
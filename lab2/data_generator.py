@@ -1,30 +1,30 @@
 """
-Генератор данных. Стирает всё содержимое books.txt и заполняет заново по некоторым
-правилам. Заполнение происходит через DBWorker, чтобы гарантировать отсутствие
-повторов названий книг. В условии цикла указано количество требуемых записей, можно
-заменить 10000 на произвольное значение
-Использование DBWorker вынуждает с большой скоростью перезаписывать файл на диске,
-что круто насилует винчестер, поэтому лично от себя рекомендую по возможности вообще
-это не запускать
+Генератор данных. Стирает всё содержимое books.txt вместе с журналом изменений
+books.txt.log и заполняет заново по некоторым правилам. Заполнение происходит через
+DBWorker, чтобы гарантировать отсутствие повторов названий книг. BOOK_COUNT задаёт
+количество требуемых записей, его можно заменить на произвольное значение
+Книги передаются DBWorker'у пачками по BATCH_SIZE штук через add_books, и файл
+перезаписывается один раз на пачку, а не на каждую книгу, так что винчестер
+больше не страдает
 """
+import os
 from random import choice, randint
 from faker import Faker                # pip install faker
 from server import DBWorker
 
+BOOK_COUNT = 10000
+BATCH_SIZE = 1000
+
 fake = Faker("ru_RU")
 genres = ["Фантастика", "Детектив", "Роман", "Научная литература", "История", "Поэзия"]
 
-with open("books.txt", "w"): pass
-
-db_worker = DBWorker("books.txt")
-add_count = 0
-while add_count < 10000:
+def generate_book():
     year = str(randint(1900, 2020))
     lib_date = str(randint(1,30))+"."+str(randint(1,11))+"."+str(int(year)+randint(1, 4))
     read_date = str(int(lib_date.split(".")[0])+randint(1, 31-int(lib_date.split(".")[0])))+"."+ \
                 str(int(lib_date.split(".")[1])+randint(1, 12-int(lib_date.split(".")[1])))+"."+ \
                 str(int(lib_date.split(".")[2])+randint(1, 2025-int(lib_date.split(".")[2])))
-    book = [
+    return [
         fake.catch_phrase(),                                        # Название
         choice(genres),                                             # Жанр
         fake.last_name()+" " +fake.first_name(),                    # Авторы
@@ -37,6 +37,15 @@ while add_count < 10000:
         read_date,                                                  # Дата прочтения
         str(randint(1, 5))+" "+fake.sentence()                      # Отзыв
     ]
-    if db_worker.add_book(book):
-        add_count += 1
-        print(add_count)
+
+with open("books.txt", "w"): pass
+if os.path.exists("books.txt.log"):    # Иначе DBWorker применит старые изменения
+    os.remove("books.txt.log")         # поверх пустого файла
+
+db_worker = DBWorker("books.txt")
+add_count = 0
+while add_count < BOOK_COUNT:
+    batch = [generate_book() for i in range(min(BATCH_SIZE, BOOK_COUNT-add_count))]
+    accepted, rejected = db_worker.add_books(batch)
+    add_count += accepted
+    print(add_count)
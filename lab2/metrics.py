@@ -0,0 +1,153 @@
+"""
+Счётчики работы сервера: количество и время выполнения запросов по командам,
+принятые и отправленные байты, подключения, ожидание мьютекса DBWorker и время
+записи на диск. Их отдаёт команда 19 и, если нужно, фоновый поток раз в несколько
+секунд дописывает в файл строкой json.
+
+Время хранится гистограммами с корзинами, которые растут в 2^(1/4) раза (около
+19%), поэтому p50, p95 и p99 считаются без хранения всех замеров с точностью до
+корзины, а запись замера - это поиск корзины и одно сложение. Все времена в
+ответах - целые микросекунды, их понимают оба кодека
+"""
+import bisect
+import json
+import threading
+import time
+
+
+BUCKETS = sorted({int(2 ** (i/4)) for i in range(4*37)}) # Верхние границы корзин
+                                                         # в микросекундах, до ~2 минут
+PERCENTILES = (50, 95, 99)
+
+
+class Histogram:
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counts = [0] * (len(BUCKETS)+1)    # Последняя корзина - всё, что дольше
+        self.count = 0
+        self.total = 0                            # Сумма замеров в микросекундах
+        self.max = 0
+
+    def record(self, seconds):
+        micros = int(seconds * 1_000_000)
+        with self.__lock:
+            self.__counts[bisect.bisect_left(BUCKETS, micros)] += 1
+            self.count += 1
+            self.total += micros
+            self.max = max(self.max, micros)
+
+    def stats(self):                              # Количество, среднее, перцентили и
+        with self.__lock:                         # максимум в микросекундах
+            counts, count, total, top = list(self.__counts), self.count, self.total, self.max
+        stats = {"count": count, "mean": total // count if count else 0}
+        for percentile in PERCENTILES:
+            rank, seen = count * percentile / 100, 0
+            for bucket, bucket_count in enumerate(counts):
+                seen += bucket_count
+                if seen >= rank:
+                    break
+            bound = BUCKETS[bucket] if bucket < len(BUCKETS) else top
+            stats[f"p{percentile}"] = min(bound, top) # Граница корзины, но не больше
+        stats["max"] = top                            # самого долгого замера
+        return stats
+
+
+class TimedLock:
+    """
+    Мьютекс, который замечает, сколько его ждали. Свободный мьютекс берётся с
+    первой попытки без замера времени, а ожидание занятого попадает в гистограмму,
+    поэтому без соперников он почти так же дёшев, как обычный. Счётчик acquired
+    меняется только под самим мьютексом, и своя блокировка ему не нужна
+    """
+    def __init__(self, waits):
+        self.__lock = threading.Lock()
+        self.waits = waits                        # Гистограмма ожиданий занятого мьютекса
+        self.acquired = 0
+
+    def __enter__(self):
+        if not self.__lock.acquire(blocking=False):
+            start = time.perf_counter()
+            self.__lock.acquire()
+            self.waits.record(time.perf_counter() - start)
+        self.acquired += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.__lock.release()
+
+
+class Metrics:
+    """
+    Все счётчики сервера. Общий экземпляр живёт в DBWorker (db_worker.metrics),
+    поэтому и потоковый, и асинхронный сервер пишут в него одинаково, а команда 19
+    получает его так же, как команда 9 получает кэш
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__started = time.monotonic()
+        self.__commands = dict()                  # Гистограммы времени по номеру команды
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.active = 0                           # Открытые подключения
+        self.accepted = 0                         # Принятые и отклонённые за всё время
+        self.rejected = 0
+        self.lock_wait = Histogram()              # Ожидание мьютекса DBWorker
+        self.disk_write = Histogram()             # Запись пачки изменений на диск
+        self.__locks = list()
+
+    def timed_lock(self):                         # Мьютекс, ожидание которого считается
+        lock = TimedLock(self.lock_wait)
+        self.__locks.append(lock)
+        return lock
+
+    def request(self, opcode, seconds, received, sent):
+        with self.__lock:
+            histogram = self.__commands.get(opcode)
+            if histogram is None:
+                histogram = self.__commands[opcode] = Histogram()
+            self.bytes_in += received
+            self.bytes_out += sent
+        histogram.record(seconds)
+
+    def connection_opened(self):
+        with self.__lock:
+            self.active += 1
+            self.accepted += 1
+
+    def connection_closed(self):
+        with self.__lock:
+            self.active -= 1
+
+    def connection_rejected(self):
+        with self.__lock:
+            self.rejected += 1
+
+    def snapshot(self):
+        with self.__lock:
+            commands = dict(self.__commands)
+            snapshot = {
+                "uptime": int(time.monotonic() - self.__started),
+                "connections": {"active": self.active, "accepted": self.accepted,
+                                "rejected": self.rejected},
+                "bytes": {"in": self.bytes_in, "out": self.bytes_out},
+            }
+        snapshot["commands"] = {opcode: histogram.stats()
+                                for opcode, histogram in sorted(commands.items())}
+        snapshot["lock_wait"] = self.lock_wait.stats()
+        snapshot["lock_wait"]["acquired"] = sum(lock.acquired for lock in self.__locks)
+        snapshot["disk_write"] = self.disk_write.stats()
+        return snapshot
+
+    def dump_every(self, filename, interval):
+        """
+        Фоновый поток, который раз в interval секунд дописывает снимок счётчиков в
+        файл одной строкой json с временем снимка, чтобы по файлу можно было
+        построить график
+        """
+        def dump():
+            while True:
+                time.sleep(interval)
+                snapshot = {"time": int(time.time()), **self.snapshot()}
+                with open(filename, "a", encoding="utf-8") as file:
+                    file.write(json.dumps(snapshot) + "\n")
+        threading.Thread(target=dump, daemon=True).start()
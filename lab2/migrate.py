@@ -0,0 +1,22 @@
+"""
+Одноразовый перенос книг из текстового файла в базу SQLite. Читает books.txt вместе
+с журналом изменений через DBWorker и записывает все книги в базу одной транзакцией.
+Если в базе уже есть книги, ничего не делает, чтобы случайно не затереть данные.
+Использование: python migrate.py books.txt books.db
+После переноса сервер запускается с базой: python server.py --db books.db
+"""
+import sys
+from server import DBWorker
+from storage import SQLiteStorage
+
+if len(sys.argv) != 3:
+    print("Использование: python migrate.py books.txt books.db")
+    sys.exit(1)
+
+source = DBWorker(sys.argv[1])
+target = SQLiteStorage(sys.argv[2], lazy=False)
+if next(target.load(), None):
+    print(f"В базе '{sys.argv[2]}' уже есть книги, перенос отменён")
+    sys.exit(1)
+target.save(source.books)
+print(f"Перенесено книг: {len(source.get_book_list())}")
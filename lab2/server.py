@@ -1,195 +1,1250 @@
-import os                  # Нужна для определения файлов в папке
-import json                # Нужна для "запаковывания" данных
 import socket              # Нужна для отправки и получения данных от клиентов
+import argparse            # Нужна для разбора параметров запуска
 import threading           # Нужна для работы с несколькими клиентами разом
+import time                # Нужна для паузы между групповыми записями
+import bisect              # Нужна для поиска места продолжения в снимке книг
+import zlib                # Нужна для сжатия больших ответов
+import queue               # Нужна для передачи подключений пулу потоков
+import selectors           # Нужна, чтобы ждать данные сразу от всех клиентов
+import logging             # Нужна для журнала работы сервера
+import logging.handlers
+from itertools import islice
+from collections import OrderedDict, deque
+from storage import Book, BOOK_FIELDS, JOURNAL_LIMIT, open_storage
+from codec import DEFAULT_CODEC, get_codec # Кодеки для "запаковывания" данных
+from metrics import Metrics # Счётчики для команды 19
 
 
 CHUNK_SIZE = 4096          # Размер пачки, которую можно отправить и принять разом
+MAX_REQUEST_SIZE = 16 * 1024 * 1024 # Запрос больше этого считается испорченным
 MAX_BAD_REQ_COUNT = 5      # Сколько плохих запросов нужно для закрытия соединения
 PORT = 9090                # Порт сервера
 CMD_SEP = "*-*"            # Разделитель в командах, ставится между аргументами
-CLIENT_LOCK = 0            # Порт клиента, который сейчас работает с данными
+DATA_COMMANDS = ("3", "7", "8") # Команды, у которых после разделителя идут данные
+GRAM_SIZE = 3              # Длина кусочков строк в поисковом индексе
+DB_FILE = "books.txt"      # Файл с книгами по умолчанию
+DURABILITY = "group"       # Когда отвечать клиенту: sync, group или async
+COMMIT_INTERVAL = 10       # Сколько миллисекунд копить изменения для групповой записи
+BATCH_OPS = {              # Операции пачки (команда 8) и типы их аргументов
+    "get": (str,),
+    "find": (str,),
+    "add": (list,),
+    "edit": (str, int, str),
+    "remove": (str,),
+}
+PAGE_SIZE = 100            # Сколько книг отдавать на страницу по умолчанию
+STREAM_CHUNK = 1000        # Сколько книг отправлять одной частью при потоковой выдаче
+QUERY_CACHE_SIZE = 256     # Сколько результатов поиска помнить
+COMPRESSIONS = ("none", "zlib") # Какое сжатие ответов можно выбрать рукопожатием
+COMPRESS_THRESHOLD = 1024  # Ответы меньше этого не сжимаются
+COMPRESS_LEVEL = 1         # Быстрое сжатие: ответ нужен сейчас, а не самый маленький
+COMPRESSED_FLAG = 1 << 31  # Старший бит размера ответа - признак сжатия
+WORKERS = 16               # Сколько потоков обслуживает клиентов
+MAX_CONNECTIONS = 256      # Сколько клиентов может быть подключено одновременно
+IDLE_TIMEOUT = 300         # Через сколько секунд молчания клиент отключается
+IO_TIMEOUT = 10            # Сколько секунд ждать клиента, который не забирает ответ
+BACKLOG = 128              # Сколько подключений может ждать принятия
+BUSY_RESPONSE = (0xFFFFFFFF).to_bytes(4, byteorder="big") # Ответ "сервер занят"
+CONFLICT = 2               # Ответ на изменение книги, которую уже изменил кто-то другой
+NOT_MODIFIED = (0xFFFFFFFE).to_bytes(4, byteorder="big") # Ответ "у вас последняя версия"
+BAD_REQUEST = (0xFFFFFFFD).to_bytes(4, byteorder="big") # Ответ "запрос не понят"
+SUBSCRIBER_QUEUE = 1000    # Сколько событий может ждать отправки одному подписчику
+HEARTBEAT = 30             # Раз во сколько секунд без событий подписчику уходит пустая
+                           # пачка, чтобы отвалившийся клиент заметили
+LOG_LEVEL = "INFO"         # Подключения видны в журнале, каждый запрос - только на DEBUG
+METRICS_INTERVAL = 10      # Раз во сколько секунд дописывать счётчики в файл
+
+log = logging.getLogger("library")
+
+
+class VersionConflict(Exception): # Книгу изменили после того, как клиент её прочитал
+    pass
+
+
+class QueryCache:
+    """
+    Результаты поиска по строке (уже в нижнем регистре) с вытеснением давно не
+    нужных. Вместе с результатом хранятся и его упаковки для отправки по кодекам
+    и сжатию, чтобы повторный запрос не сериализовался заново. При изменении книги сбрасываются
+    только те строки, которые находятся в её названии, авторах или жанре, - до или
+    после изменения, остальные результаты от этой книги не зависят
+    """
+    def __init__(self, size=QUERY_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()            # Строка -> [результат, упаковки]
+        self.__lock = threading.Lock()            # Читатели приходят без мьютекса DBWorker
+        self.__version = 0                        # Растёт при каждом сбросе
+
+    def get(self, query):                         # Запись и номер версии для put
+        with self.__lock:
+            entry = self.__entries.get(query)
+            if entry is None:
+                self.misses += 1
+                return None, self.__version
+            self.hits += 1
+            self.__entries.move_to_end(query)
+            return entry, self.__version
+
+    def put(self, query, entry, version):
+        """
+        Результат, посчитанный до очередного сброса, мог устареть, пока его искали,
+        поэтому он не запоминается
+        """
+        with self.__lock:
+            if version != self.__version or not self.size:
+                return
+            self.__entries[query] = entry
+            self.__entries.move_to_end(query)
+            if len(self.__entries) > self.size:
+                self.__entries.popitem(last=False)
+
+    def invalidate(self, *fields):               # Поля поиска книги до и после изменения
+        with self.__lock:
+            self.__version += 1
+            if not self.__entries:
+                return
+            fields = [field.lower() for field in fields]
+            for query in [query for query in self.__entries
+                          if any(query in field for field in fields)]:
+                del self.__entries[query]
+
+    def clear(self):
+        with self.__lock:
+            self.__version += 1
+            self.__entries.clear()
+
+    def stats(self):
+        with self.__lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self.__entries), "capacity": self.size}
+
+
+class Subscription:
+    """
+    Очередь событий одного подписчика (команда 40). Событие - [вид, название, номер
+    поля, версия]: ["add", название, None, версия], ["edit", название, номер поля,
+    версия] или ["remove", название, None, версия], а у переименования в конце ещё
+    старое название. События кладёт DBWorker под своим мьютексом, и ждать он не
+    должен, поэтому очередь ограничена: если подписчик не успевает забирать, он
+    помечается как overflowed, новые события ему больше не кладутся, а сервер
+    отправляет ему событие "resync" и отключает - клиент должен перечитать каталог.
+    notify будит того, кто ждёт событий: по умолчанию поток в wait, а асинхронный
+    сервер подставляет свою функцию
+    """
+    def __init__(self, size=SUBSCRIBER_QUEUE):
+        self.size = size
+        self.overflowed = False
+        self.__events = deque()
+        self.__wakeup = threading.Event()
+        self.notify = self.__wakeup.set
+
+    def publish(self, event):
+        if self.overflowed:
+            return
+        if len(self.__events) >= self.size:
+            self.overflowed = True
+        else:
+            self.__events.append(event)
+        self.notify()
+
+    def take(self):                               # Все накопившиеся события
+        events = list()
+        while self.__events:
+            events.append(self.__events.popleft())
+        return events
+
+    def wait(self, timeout):                      # События или пустой список по таймауту
+        self.__wakeup.wait(timeout)
+        self.__wakeup.clear()                     # Сначала сброс, потом разбор очереди,
+        return self.take()                        # иначе можно проспать событие
 
 
 class DBWorker: # Класс для работы с файлом
-    def __init__(self, filename):
-        self.lock = threading.Lock()              # Создаём мьютекс для работы внутри
+    """
+    Изменения сначала вносятся в память под мьютексом lock и встают в очередь на
+    запись, а на диск попадают пачками уже без него, поэтому запись на диск не держит
+    других клиентов. Когда изменение считается сохранённым, задаёт durability:
+    - sync - каждый запрос сам записывает очередь на диск и только потом получает ответ
+    - group - фоновый поток раз в commit_interval мс записывает всё накопившееся одной
+      пачкой, а запросы ждут записи своей пачки (групповая запись)
+    - async - запрос получает ответ сразу, фоновый поток пишет позже, и при падении
+      можно потерять изменения за последние commit_interval мс
+    """
+    def __init__(self, filename, journal=False, journal_limit=JOURNAL_LIMIT, lazy=False,
+                 durability="sync", commit_interval=COMMIT_INTERVAL,
+                 query_cache=QUERY_CACHE_SIZE):
+        self.metrics = Metrics()                  # Счётчики сервера, в том числе
+        self.lock = self.metrics.timed_lock()     # ожидания мьютекса для работы внутри
         self.filename = filename                  # объекта класса
-        if self.filename not in os.listdir():
-            f = open(self.filename, "w")
-            f.close()
-        self.__books = list()
-        self.__init_books()
+        self.storage = open_storage(filename, journal, journal_limit, lazy)
+                                                  # Хранилище выбирается по расширению:
+                                                  # books.txt или база SQLite books.db
+        self.durability = durability
+        self.commit_interval = commit_interval
+        self.__io_lock = threading.Lock()         # Одновременно пишет на диск один поток
+        self.__pending = list()                   # Очередь изменений на запись
+        self.__logged = 0                         # Номер последнего изменения в очереди
+        self.__flushed = 0                        # и последнего записанного на диск
+        self.__flushed_cond = threading.Condition()
+        self.__dirty = threading.Event()          # Будит фоновый поток записи
+        self.__books = dict()                     # Книги по порядковому номеру и
+        self.__titles = dict()                    # номера книг по названию, чтобы
+        self.__next_id = 0                        # не перебирать весь каталог
+        self.__grams = None                       # Поисковый индекс, строится при первом поиске
+        self.__generation = 0                     # Номер версии книг, растёт с каждым изменением
+        self.__view = (-1, ())                    # Снимок книг для читателей и его версия
+        self.cache = QueryCache(query_cache)      # Результаты повторяющихся поисков
+        self.__versions = dict()                  # Версии изменённых книг по номеру.
+        self.__base_version = time.time_ns()      # У остальных - версия запуска, поэтому
+        self.__last_version = self.__base_version # версии не повторяются и между запусками
+        self.__subscribers = set()                # Очереди событий подписчиков
+        for book in self.storage.load():
+            self.__insert(book)
+        for record in self.storage.replay():      # Изменения из журнала применяются
+            self.__apply(record)                  # поверх загруженного снимка
+        self.storage.replayed(self.__snapshot)
+        if self.durability != "sync":
+            threading.Thread(target=self.__flusher, daemon=True).start()
     
     @property                                     # books теперь свойство, чтобы мы могли
     def books(self):                              # использовать мьютекс при работе с ним
-        return self.__books
+        return [book.to_list() for _, book in self.__books_view()]
     
     @books.setter                                 # Одновременно список книг
     def books(self, value):                       # может изменять только один поток.
         with self.lock:                           # Эта конструкция с with позволяет
-            self.__books = value                  # удобно использовать мьютекс
-    
-    def __init_books(self):
-        with open(self.filename, "r") as file:
-            lines = file.readlines()
-            for i in range(len(lines)//11):
-                book = list()
-                for j in range(11):
-                    book.append(lines[i*11+j][:-1])
-                self.books.append(book)
-    
-    def __write_data(self):
-        with self.lock:                            # Одновременно с файлом может работать
-            with open(self.filename, "w") as file: # только один поток
-                for book in self.books:
-                    for line in book:
-                        file.write(line+"\n")
+            self.__books = dict()                 # удобно использовать мьютекс
+            self.__titles = dict()
+            self.__grams = None
+            self.cache.clear()
+            self.__versions = dict()
+            self.__last_version += 1
+            self.__base_version = self.__last_version
+            for subscription in self.__subscribers: # Каталог заменён целиком, подписчикам
+                subscription.overflowed = True    # проще перечитать его, чем разбирать
+                subscription.notify()             # события о каждой книге
+            self.__subscribers = set()
+            for book in value:
+                self.__add(book)
+            self.__generation += 1
+    
+    def __books_view(self):
+        """
+        Неизменяемый снимок книг для читателей: кортеж пар (номер, книга). Читатели не
+        берут мьютекс и перебирают снимок, а не живой словарь, который в это время
+        могут менять писатели. Писатели снимков не строят, а только увеличивают номер
+        версии после изменения. Первый читатель после изменения копирует словарь
+        (копирование идёт одной операцией на C и не прерывается другими потоками) и
+        подменяет снимок целиком, остальные пользуются готовым. Номер версии
+        читается до копирования, поэтому снимок никогда не окажется старее своего
+        номера, а устаревший снимок будет перестроен следующим читателем
+        """
+        generation, view = self.__view
+        if generation != self.__generation:
+            generation = self.__generation
+            view = tuple(self.__books.items())
+            self.__view = (generation, view)
+        return view
+    
+    def __snapshot(self):
+        """
+        Книги для полной перезаписи. Вызывается только под мьютексом, иначе снимок
+        разойдётся с очередью изменений. Копировать книги не нужно: изменение
+        подменяет книгу копией (__edit), а не правит её, поэтому книги снимка уже
+        не изменятся. Это те же книги, что и в каталоге, так что ленивые из них
+        дочитываются при записи и не теряют источник, который запись закрывает
+        """
+        return list(self.__books.values())
+    
+    def __log(self, record):                       # Вызывается под мьютексом сразу после
+        self.__generation += 1                     # изменения, чтобы порядок записей
+        self.__pending.append(record)              # совпадал с порядком изменений, а
+        self.__logged += 1                         # читатели увидели новую версию
+        self.__dirty.set()
+        return self.__logged
+    
+    def __flush(self, compact=False):
+        """
+        Записывает на диск всё, что накопилось в очереди, одной пачкой. Поток, который
+        пришёл за своим изменением, заодно сохраняет и чужие, так что при одновременной
+        записи многих клиентов на диск уходит одна пачка вместо многих.
+        Если запись перезапишет весь файл (или нужно слияние, compact), снимок книг
+        берётся под тем же мьютексом, что и очередь: изменения, сделанные после,
+        остаются в следующей пачке и не попадут в файл раньше своих записей в журнале
+        """
+        with self.__io_lock:
+            with self.lock:
+                records, self.__pending = self.__pending, list()
+                logged = self.__logged
+                snapshot = None
+                if compact or (records and self.storage.saves_on_write(len(records))):
+                    snapshot = self.__snapshot()
+            if records or compact:
+                start = time.perf_counter()
+                try:
+                    if compact:                    # Снимок уже включает все записи пачки
+                        self.storage.save(snapshot)
+                    else:
+                        self.storage.write(records, lambda: snapshot)
+                except:                            # Не записанное вернётся в очередь
+                    with self.lock:
+                        self.__pending[:0] = records
+                    raise
+                self.metrics.disk_write.record(time.perf_counter() - start)
+            with self.__flushed_cond:
+                self.__flushed = logged
+                self.__flushed_cond.notify_all()
+    
+    def __flusher(self):                           # Фоновый поток групповой записи
+        while True:
+            self.__dirty.wait()
+            time.sleep(self.commit_interval/1000)  # Даём набраться пачке
+            self.__dirty.clear()
+            try:
+                self.__flush()
+            except Exception as e:                 # Пачка вернулась в очередь, и её
+                log.error("Ошибка записи на диск: %s", e) # ждут клиенты, поэтому
+                self.__dirty.set()                 # повторяем, не дожидаясь новых изменений
+    
+    def __commit(self, logged):                    # Ждёт сохранения изменения по режиму
+        if self.durability == "sync":
+            self.__flush()
+        elif self.durability == "group":
+            with self.__flushed_cond:
+                self.__flushed_cond.wait_for(lambda: self.__flushed >= logged)
+    
+    def close(self):                               # Дописывает очередь перед завершением
+        self.__flush()
+    
+    def compact(self):                             # Принудительное слияние журнала
+        self.__flush(compact=True)
     
     def get_book_list(self):
-        return list(map(lambda x: x[0], self.books))
+        return [book.title for _, book in self.__books_view()]
+    
+    def __iter_books(self, after):                # Книги снимка с номерами больше after
+        view = self.__books_view()
+        start = bisect.bisect_right(view, after, key=lambda item: item[0])
+        return islice(view, start, None)
+    
+    def get_book_page(self, cursor=None, limit=PAGE_SIZE):
+        """
+        Страница списка названий. Курсор - номер последней выданной книги: номера
+        растут в порядке добавления и не меняются при переименовании, поэтому
+        добавления и удаления между запросами страниц не сдвигают выдачу. Возвращает
+        названия и курсор следующей страницы или None, если страница последняя
+        """
+        return self.__page(self.__iter_books(-1 if cursor is None else cursor), limit,
+                           lambda book: book.title)
+    
+    def iter_book_list(self, chunk=STREAM_CHUNK): # Список названий частями по chunk штук
+        for page in self.__chunks(self.__iter_books(-1), chunk):
+            yield [book.title for _, book in page]
+    
+    @staticmethod
+    def __book_grams(book):                       # Все тройки подряд идущих символов из
+        grams = set()                             # названия, авторов и жанра. Тройки не
+        for field in (book.title, book.authors, book.genre): # пересекают границы полей
+            field = field.lower()
+            for i in range(len(field)-GRAM_SIZE+1):
+                grams.add(field[i:i+GRAM_SIZE])
+        return grams
     
-    def find_books(self, string):
+    def __index_book(self, book_id, book):
+        if self.__grams is not None:
+            for gram in self.__book_grams(book):
+                self.__grams.setdefault(gram, set()).add(book_id)
+    
+    def __unindex_book(self, book_id, book):
+        if self.__grams is not None:
+            for gram in self.__book_grams(book):
+                ids = self.__grams[gram]
+                ids.discard(book_id)
+                if not ids:
+                    del self.__grams[gram]
+    
+    def __build_index(self):
+        """
+        Инвертированный индекс: для каждой тройки символов хранится множество номеров
+        книг, в которых она встречается. Строится один раз при первом поиске, дальше
+        поддерживается добавлением, изменением и удалением книг
+        """
+        with self.lock:                           # Индекс собирается целиком и только
+            if self.__grams is None:              # потом становится виден читателям,
+                grams = dict()                    # иначе параллельный поиск увидит
+                for book_id, book in self.__books.items(): # недостроенный индекс
+                    for gram in self.__book_grams(book):
+                        grams.setdefault(gram, set()).add(book_id)
+                self.__grams = grams
+    
+    def __find(self, string, after=-1):
+        """
+        Если строка не короче тройки, кандидатами становятся только книги, в которых
+        есть все её тройки. Кандидатов всё равно проверяем честным поиском подстроки,
+        поэтому результат совпадает с полным перебором, включая порядок книг.
+        Мьютекс не берётся: короткие строки ищутся по снимку книг, а операции над
+        множествами индекса выполняются на C целиком, не прерываясь писателями.
+        Выдаёт пары (номер, книга) по одной, начиная с номеров больше after
+        """
         string = string.lower()
-        found_books = list()
-        for book in self.books:
-            if string in book[0].lower() or \
-               string in book[1].lower() or \
-               string in book[2].lower():
-               found_books.append(book)
-        return found_books
+        if len(string) < GRAM_SIZE:
+            candidates = self.__iter_books(after)
+        else:
+            if self.__grams is None:
+                self.__build_index()
+            postings = list()
+            for i in range(len(string)-GRAM_SIZE+1):
+                postings.append(self.__grams.get(string[i:i+GRAM_SIZE], set()))
+            postings.sort(key=len)                # Пересечение начинаем с самого редкого
+            candidates = set(postings[0])
+            for ids in postings[1:]:
+                if not candidates:
+                    break
+                candidates &= ids
+            candidates = [(book_id, self.__books.get(book_id)) # Номера растут в
+                          for book_id in sorted(candidates)    # порядке добавления
+                          if book_id > after]
+        for book_id, book in candidates:
+            if book is not None and (string in book.title.lower() or
+                                     string in book.authors.lower() or
+                                     string in book.genre.lower()):
+                yield book_id, book
+    
+    def __cached_find(self, string):              # Запись кэша [результат, упаковки]
+        query = string.lower()
+        entry, version = self.cache.get(query)
+        if entry is None:
+            entry = [[book.to_list() for _, book in self.__find(query)], dict()]
+            self.cache.put(query, entry, version)
+        return entry
+    
+    def find_books(self, string):                 # Результат общий с кэшем, не изменять
+        return self.__cached_find(string)[0]
+    
+    def find_books_packed(self, string, codec=DEFAULT_CODEC, compression="none"):
+        entry = self.__cached_find(string)        # Результат поиска, готовый к отправке
+        if (codec.name, compression) not in entry[1]:
+            entry[1][codec.name, compression] = pack_data(entry[0], codec, compression)
+        return entry[1][codec.name, compression]
+    
+    def find_books_page(self, string, cursor=None, limit=PAGE_SIZE):
+        """
+        Страница результатов поиска, курсор такой же, как у get_book_page
+        """
+        return self.__page(self.__find(string, -1 if cursor is None else cursor), limit,
+                           Book.to_list)
+    
+    def iter_found_books(self, string, chunk=STREAM_CHUNK): # Найденное частями
+        for page in self.__chunks(self.__find(string), chunk):
+            yield [book.to_list() for _, book in page]
+    
+    @staticmethod
+    def __chunks(books, size):                     # Нарезка пар (номер, книга) на части
+        books = iter(books)
+        while page := list(islice(books, size)):
+            yield page
+    
+    @staticmethod
+    def __page(books, limit, convert):
+        page = list(islice(books, limit+1))        # Лишняя книга показывает, что
+        cursor = page[limit-1][0] if len(page) > limit else None # страница не последняя
+        return [convert(book) for _, book in page[:limit]], cursor
+    
+    def __insert(self, book):                     # Словари дают поиск по названию за O(1),
+        if book.title in self.__titles:           # а порядок номеров совпадает с порядком
+            return False                          # добавления книг
+        self.__books[self.__next_id] = book
+        self.__titles[book.title] = self.__next_id
+        self.__index_book(self.__next_id, book)
+        self.__next_id += 1
+        return True
+    
+    def __changed(self, book_id, *fields):        # Вызывается сразу после изменения.
+        self.__generation += 1                    # Сначала новая версия снимка, иначе
+        self.cache.invalidate(*fields)            # сброшенный поиск посчитают по старому
+        self.__last_version += 1
+        self.__versions[book_id] = self.__last_version
+    
+    def __version(self, book_id):
+        return self.__versions.get(book_id, self.__base_version)
+    
+    def __publish(self, kind, title, index=None, *extra): # Под мьютексом после __changed
+        if not self.__subscribers:
+            return
+        event = [kind, title, index, self.__last_version, *extra]
+        for subscription in list(self.__subscribers):
+            subscription.publish(event)
+            if subscription.overflowed:           # Не успевающий подписчик больше
+                self.__subscribers.discard(subscription) # событий не получит
+    
+    def subscribe(self, size=SUBSCRIBER_QUEUE):
+        """
+        Новая очередь событий. Первое событие в ней - ["subscribed", None, None,
+        версия каталога], все следующие изменения будут новее этой версии
+        """
+        subscription = Subscription(size)
+        with self.lock:
+            subscription.publish(["subscribed", None, None, self.__last_version])
+            self.__subscribers.add(subscription)
+        return subscription
+    
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.__subscribers.discard(subscription)
+    
+    def __check_version(self, book_name, version):
+        """
+        Оптимистичная блокировка: клиент передаёт версию книги, которую прочитал,
+        и если с тех пор книгу кто-то изменил, изменение отклоняется. Так клиенты,
+        которые правят разные книги, друг другу не мешают
+        """
+        book_id = self.__titles.get(book_name)
+        if version is not None and book_id is not None and \
+           self.__version(book_id) != version:
+            raise VersionConflict(book_name)
+    
+    def __add(self, data):
+        if len(data) != len(BOOK_FIELDS) or data[0] in self.__titles:
+            return False
+        book_id = self.__next_id
+        self.__insert(Book(data))
+        self.__changed(book_id, *data[:3])
+        self.__publish("add", data[0])
+        return True
+    
+    def __edit(self, book_name, index, string):
+        book_id = self.__titles.get(book_name)
+        if book_id is None or not 0 <= index < len(BOOK_FIELDS): # Отрицательный номер
+            return False                          # переименовал бы книгу мимо словаря
+        if index == 0 and string != book_name:    # При переименовании книга остаётся
+            if string in self.__titles:           # на своём месте, меняется только
+                return False                      # ключ в словаре названий
+            self.__titles[string] = self.__titles.pop(book_name)
+        book = self.__books[book_id]
+        fields = [book.title, book.authors, book.genre] # Книгу могли находить до
+        if index < 3:                             # изменения или начать находить после.
+            self.__unindex_book(book_id, book)    # Индекс затрагивают только поля поиска
+            fields.append(string)
+        book = book.copy()                        # Книгу читают без мьютекса, поэтому
+        book[index] = string                      # меняется копия, и читатель видит
+        self.__books[book_id] = book              # либо старую книгу, либо новую целиком
+        if index < 3:
+            self.__index_book(book_id, book)
+        self.__changed(book_id, *fields)
+        if index == 0 and string != book_name:
+            self.__publish("edit", string, index, book_name)
+        else:
+            self.__publish("edit", book_name, index)
+        return True
+    
+    def __remove(self, book_name):
+        book_id = self.__titles.pop(book_name, None)
+        if book_id is None:
+            return False
+        book = self.__books.pop(book_id)
+        self.__unindex_book(book_id, book)
+        self.__changed(book_id, book.title, book.authors, book.genre)
+        del self.__versions[book_id]
+        self.__publish("remove", book_name)
+        return True
+    
+    def __apply(self, record):                    # Применяет запись об изменении в памяти
+        match record[0]:
+            case "add":
+                return self.__add(record[1])
+            case "edit":
+                return self.__edit(record[1], record[2], record[3])
+            case "remove":
+                return self.__remove(record[1])
+        return False
     
     def add_book(self, data):
-        for book in self.books:
-            if book[0] == data[0]:
+        with self.lock:
+            if not self.__add(data):
                 return False
-        self.books.append(data)
-        self.__write_data()
+            logged = self.__log(["add", data])
+        self.__commit(logged)
         return True
     
-    def edit_book(self, book_name, index, string):
-        for book in self.books:
-            if book_name == book[0]:
-                book[index] = string
-                self.__write_data()
-                return True
-        return False
+    def add_books(self, books):
+        """
+        Массовое добавление. Повторы названий отсеиваются в памяти, а все принятые
+        книги сохраняются одной пачкой вместо отдельной записи на каждую.
+        Возвращает количество принятых и отклонённых книг
+        """
+        books = list(books)                        # Не держим мьютекс, пока их генерируют
+        accepted = rejected = logged = 0
+        with self.lock:
+            for data in books:
+                if self.__add(data):
+                    logged = self.__log(["add", data])
+                    accepted += 1
+                else:
+                    rejected += 1
+        if logged:
+            self.__commit(logged)
+        return accepted, rejected
     
-    def remove_book(self, book_name):
-        for i, book in enumerate(self.books):
-            if book_name == book[0]:
-                del self.books[i]
-                self.__write_data()
-                return True
-        return False
+    def edit_book(self, book_name, index, string, version=None):
+        """
+        Если передана версия из get_book_version, а книгу с тех пор изменили,
+        бросает VersionConflict. Номер поля вне BOOK_FIELDS - плохой запрос
+        """
+        if not 0 <= index < len(BOOK_FIELDS):
+            raise ValueError("неверный номер поля")
+        with self.lock:
+            self.__check_version(book_name, version)
+            if not self.__edit(book_name, index, string):
+                return False
+            logged = self.__log(["edit", book_name, index, string])
+        self.__commit(logged)
+        return True
+    
+    def remove_book(self, book_name, version=None): # Версия - как у edit_book
+        with self.lock:
+            self.__check_version(book_name, version)
+            if not self.__remove(book_name):
+                return False
+            logged = self.__log(["remove", book_name])
+        self.__commit(logged)
+        return True
+    
+    def __check(self, ops):
+        """
+        Проверяет, что все изменения пачки пройдут, ничего не меняя. Что станет с
+        названиями по ходу пачки, запоминается поверх словаря названий, поэтому
+        можно, например, добавить книгу и тут же её переименовать
+        """
+        present = dict()
+        def exists(title):
+            return present.get(title, title in self.__titles)
+        for op in ops:
+            match op[0]:
+                case "add":
+                    if len(op[1]) != len(BOOK_FIELDS) or exists(op[1][0]):
+                        return False
+                    present[op[1][0]] = True
+                case "edit":
+                    if not exists(op[1]):
+                        return False
+                    if op[2] == 0 and op[3] != op[1]:
+                        if exists(op[3]):
+                            return False
+                        present[op[1]], present[op[3]] = False, True
+                case "remove":
+                    if not exists(op[1]):
+                        return False
+                    present[op[1]] = False
+        return True
+    
+    def batch(self, ops, atomic=False):
+        """
+        Пачка операций за один запрос: ["get", название], ["find", строка],
+        ["add", книга], ["edit", название, номер поля, значение], ["remove", название].
+        Операции выполняются по порядку под одним мьютексом, изменения сохраняются
+        одной записью. Возвращает результаты в том же порядке: книгу, список найденных
+        или успех изменения. С atomic пачка сначала проверяется целиком, и если хоть
+        одно изменение не пройдёт, не выполняется ничего, а все результаты - False
+        """
+        ops = [parse_batch_op(op) for op in ops]
+        if self.__grams is None and any(op[0] == "find" for op in ops):
+            self.__build_index()                   # Сам берёт мьютекс, поэтому заранее
+        results, logged = list(), 0
+        with self.lock:
+            if atomic and not self.__check(ops):
+                return [False] * len(ops)
+            for op in ops:
+                match op[0]:
+                    case "get":
+                        results.append(self.get_book(op[1]))
+                    case "find":
+                        results.append(self.find_books(op[1]))
+                    case _:
+                        done = self.__apply(op)
+                        if done:
+                            logged = self.__log(op)
+                        results.append(done)
+        if logged:
+            self.__commit(logged)
+        return results
     
     def get_book(self, book_name):
-        for book in self.books:
-            if book[0] == book_name:
-                return book
-        return []
+        book = self.__books.get(self.__titles.get(book_name))
+        return [] if book is None else book.to_list()
+    
+    @property
+    def warm(self):
+        """
+        Поисковый индекс построен. Строя его, DBWorker читает авторов и жанр каждой
+        книги, поэтому ленивые книги уже дочитаны и чтение больше не ходит на диск
+        """
+        return self.__grams is not None
+    
+    @property
+    def catalogue_version(self):                  # Растёт с каждым изменением любой книги
+        return self.__last_version
+    
+    def get_book_version(self, book_name):
+        """
+        Книга вместе с версией для edit_book и remove_book. Номер книги и её версия
+        читаются одним обращением к словарю, а книга копируется после, поэтому
+        версия никогда не окажется новее книги: в худшем случае изменение с такой
+        версией получит отказ и клиенту придётся перечитать книгу
+        """
+        book_id = self.__titles.get(book_name)
+        if book_id is None:
+            return [], None
+        version = self.__version(book_id)
+        book = self.__books.get(book_id)
+        return ([], None) if book is None else (book.to_list(), version)
 
 
-def send_data(cl_sock, data):
+def pack_data(data, codec=DEFAULT_CODEC, compression="none"):
     """
-    Функция для отправки данных любого размера. Сначала происходит сериализация
-    данных в json и кодирование, считается размер в байтах. Размер отправляется
-    клиенту, чтобы он знал, сколько данных ему следует принять.
-    После этого отправляются данные пачками размером CHUNK_SIZE
+    Упаковка данных любого размера. Сначала происходит сериализация данных кодеком
+    подключения (по умолчанию в json), считается размер в байтах. Размер идёт первыми
+    четырьмя байтами, чтобы клиент знал, сколько данных ему следует принять, а за ним
+    сами данные. Если клиент согласился на сжатие, большие ответы сжимаются zlib,
+    а в размере поднимается старший бит
     """
-    dumped_data = json.dumps(data).encode("utf-8")
-    cl_sock.sendall((len(dumped_data) if data
-                    else 0).to_bytes(4, byteorder="big"))
-    if data:
-        cl_sock.sendall(dumped_data)
+    if not data:
+        return (0).to_bytes(4, byteorder="big")
+    dumped_data = codec.encode(data)
+    if compression == "zlib" and len(dumped_data) >= COMPRESS_THRESHOLD:
+        compressed = zlib.compress(dumped_data, COMPRESS_LEVEL)
+        if len(compressed) < len(dumped_data):
+            return (len(compressed) | COMPRESSED_FLAG).to_bytes(4, byteorder="big") + \
+                   compressed
+    return len(dumped_data).to_bytes(4, byteorder="big") + dumped_data
 
-def send_bool(cl_sock, value):
+def pack_bool(value):
     """
-    Функция отправки булевых значений. В этом проекте используется для отправки
+    Упаковка булевых значений. В этом проекте используется для отправки
     результата работы сервера. Единица при успехе и ноль при неудаче
     """
-    cl_sock.send(bytes([1] if value else [0]))
+    return bytes([1] if value else [0])
 
+def stream_data(chunks, pack=pack_data):
+    """
+    Потоковая выдача: каждая часть упаковывается как обычный ответ и отправляется,
+    как только готова, а конец отмечается пустой частью (нулевой размер). Так ни
+    сервер, ни клиент не собирают весь результат в одном буфере
+    """
+    for chunk in chunks:
+        yield pack(chunk)
+    yield pack([])
 
-def work_thread(cl_sock: socket.socket, cl_addr: tuple, db_worker: DBWorker) -> None:
+def version_arg(args):                       # Необязательная версия книги из команды
+    return int(args[0]) if args and args[0] else None
+
+def conditional(session, version, since, data):
     """
-    Функция работы с отдельным потоком. Она слушает порт сервера и реагирует на
-    сообщения от определённого порта клиента. В остальном, всё работает также
+    Условный ответ для команд 1, 2 и 6 с версией, которая уже есть у клиента:
+    если версия не новее, вместо данных уходят четыре байта NOT_MODIFIED, иначе
+    [данные, версия]. Версию нужно прочитать до данных, тогда данные не старее
+    версии, и в худшем случае клиент лишний раз получит то же самое
     """
-    global CLIENT_LOCK # Делаем информацию о блокировке общей для всех потоков
-    print(cl_addr[1], "соединение установлено", sep=": ")
-    bad_req_count = 0
-    running = True
-    while running:
-        try:
-            command = cl_sock.recv(CHUNK_SIZE).decode("utf-8")
-        except:
-            command = ""
-        print(cl_addr[1], command.split(CMD_SEP)[0] if command
-                          else "подозрительный запрос", sep=": ")
-        match command.split(CMD_SEP)[0]:
+    if since is not None and version is not None and version <= since:
+        return NOT_MODIFIED
+    return session.pack([data(), version])
+
+def parse_book(data):                        # Книга из данных команды - список строк.
+    if not isinstance(data, list) or \
+       not all(isinstance(field, str) for field in data): # Иначе хранилище упадёт на
+        raise ValueError("неверные поля книги") # упаковке или сохранит строку по буквам
+    return data                              # Книгу не из 11 строк DBWorker не добавит
+
+def parse_batch_op(op):                      # Испорченная операция пачки - плохой запрос
+    if not isinstance(op, list) or not op or op[0] not in BATCH_OPS:
+        raise ValueError("неизвестная операция")
+    types = BATCH_OPS[op[0]]
+    if len(op) != len(types)+1 or \
+       not all(isinstance(arg, t) for arg, t in zip(op[1:], types)):
+        raise ValueError("неверные аргументы операции")
+    if op[0] == "add":
+        parse_book(op[1])
+    if op[0] == "edit" and not 0 <= op[2] < len(BOOK_FIELDS):
+        raise ValueError("неверный номер поля")
+    return op
+
+def page_args(args):                         # Курсор и размер страницы из команды
+    cursor = int(args[0]) if len(args) > 0 and args[0] else None
+    limit = int(args[1]) if len(args) > 1 and args[1] else PAGE_SIZE
+    if limit < 1:
+        raise ValueError("пустая страница")
+    return cursor, limit
+
+def send_data(cl_sock, data):                # Отправка данных любого размера, сокет
+    cl_sock.sendall(pack_data(data))         # сам делит их на пачки
+
+def send_bool(cl_sock, value):
+    cl_sock.send(pack_bool(value))
+
+
+def unpack_size(header):                     # Размер запроса из первых четырёх байт
+    return int.from_bytes(header, byteorder="big")
+
+
+class FrameBuffer:
+    """
+    Накопитель байт, пришедших от клиента. Запрос оформлен так же, как ответ: четыре
+    байта размера и сама команда. Байты из сокета докладываются в буфер через feed,
+    а обратно выдаются только запросы, пришедшие целиком, поэтому длинная команда
+    может прийти за несколько recv, а несколько команд - за один
+    """
+    def __init__(self):
+        self.__buffer = bytearray()
+
+    def feed(self, data):
+        self.__buffer += data
+        commands, start = list(), 0
+        while len(self.__buffer) - start >= 4:
+            size = unpack_size(self.__buffer[start:start+4])
+            if size > MAX_REQUEST_SIZE:
+                raise ValueError("слишком большой запрос")
+            if len(self.__buffer) - start - 4 < size: # Запрос ещё не дошёл целиком
+                break
+            commands.append(bytes(self.__buffer[start+4:start+4+size]))
+            start += 4 + size
+        del self.__buffer[:start]
+        return commands
+
+
+def command_opcode(command):                 # Номер команды из байт запроса
+    return command.partition(CMD_SEP.encode("utf-8"))[0].decode("utf-8", "replace")
+
+
+class Session: # Состояние одного подключения, общее для потокового и асинхронного сервера
+    def __init__(self, port):
+        self.port = port                     # Порт клиента, по нему клиент виден в журнале
+        self.bad_req_count = 0
+        self.running = True
+        self.codec = DEFAULT_CODEC           # Кодек ответов и данных в запросах
+        self.compression = "none"            # Сжатие больших ответов
+
+    def configure(self, options):
+        """
+        Рукопожатие: параметры вида "codec=binary" и "compression=zlib". Применяются,
+        только если все они понятны серверу, иначе подключение остаётся как было
+        """
+        codec, compression = self.codec, self.compression
+        for option in options:
+            key, _, value = option.partition("=")
+            if key == "codec" and get_codec(value):
+                codec = get_codec(value)
+            elif key == "compression" and value in COMPRESSIONS:
+                compression = value
+            else:
+                return False
+        self.codec, self.compression = codec, compression
+        return True
+
+    def pack(self, data):                    # Упаковка ответа так, как договорились
+        return pack_data(data, self.codec, self.compression)
+
+
+def handle_command(command, session, db_worker):
+    """
+    Выполняет одну команду клиента (байты запроса) и возвращает байты ответа (для
+    команды 20 ответа нет, тогда возвращается пустая строка байт), для потоковых
+    команд 13 и 14 - генератор частей ответа, а для подписки (команда 40) - очередь
+    событий Subscription, которую сервер дальше отправляет сам. Сокет здесь не
+    нужен, поэтому функцию используют и потоковый сервер, и асинхронный из
+    async_server.py.
+    Время выполнения и размеры запроса и ответа попадают в db_worker.metrics по
+    номеру команды, а плохие запросы - под номером "bad", чтобы мусор от клиента
+    не плодил счётчики
+    """
+    start = time.perf_counter()
+    opcode = command_opcode(command)
+    log.debug("%s: %s", session.port, opcode if command else "подозрительный запрос")
+    bad_req_count = session.bad_req_count
+    response = run_command(opcode, command, session, db_worker)
+    if session.bad_req_count != bad_req_count:
+        opcode = "bad"
+    if isinstance(response, bytes):
+        db_worker.metrics.request(opcode, time.perf_counter() - start,
+                                  len(command) + 4, len(response))
+        return response
+    if isinstance(response, Subscription):       # Подписка длится, пока клиент не уйдёт,
+        db_worker.metrics.request(opcode, time.perf_counter() - start, # поэтому считается
+                                  len(command) + 4, 0)                # только её начало
+        return response
+    return metered_stream(response, db_worker.metrics, opcode, start, len(command) + 4)
+
+def metered_stream(chunks, metrics, opcode, start, received):
+    """
+    Потоковый ответ считается, когда отправлена последняя часть или клиент
+    отключился на середине, поэтому его время - это время всей выдачи
+    """
+    sent = 0
+    try:
+        for chunk in chunks:
+            sent += len(chunk)
+            yield chunk
+    finally:
+        metrics.request(opcode, time.perf_counter() - start, received, sent)
+
+def run_command(opcode, command, session, db_worker):
+    """
+    Аргументы команд - текст через разделитель, а данные команд из DATA_COMMANDS
+    после разделителя разбирает кодек подключения, поэтому они могут быть двоичными.
+    Команда с недостающими или испорченными аргументами считается плохим запросом.
+    На него тоже приходит ответ, BAD_REQUEST: клиент может отправить несколько
+    запросов подряд, и ответ на каждый должен прийти, иначе ответы на следующие
+    будут прочитаны не теми запросами. Без ответа остаются только команды 20 и 0
+    """
+    codec = session.codec
+    try:
+        if opcode in DATA_COMMANDS:
+            data = codec.decode(command.partition(CMD_SEP.encode("utf-8"))[2])
+        else:
+            args = command.decode("utf-8").split(CMD_SEP)
+        match opcode:
+            case "1" if len(args) > 1: # С версией каталога - условный запрос
+                return conditional(session, db_worker.catalogue_version,
+                                   version_arg(args[1:]), db_worker.get_book_list)
             case "1":
                 book_list = db_worker.get_book_list()
-                send_data(cl_sock, book_list)
+                return session.pack(book_list)
+            case "2" if len(args) > 2:
+                return conditional(session, db_worker.catalogue_version,
+                                   version_arg(args[2:]),
+                                   lambda: db_worker.find_books(args[1]))
             case "2":
-                search_string = command.split(CMD_SEP)[1]
-                found_books = db_worker.find_books(search_string)
-                send_data(cl_sock, found_books)
+                return db_worker.find_books_packed(args[1], codec,
+                                                 session.compression)
+            case "9":       # Счётчики кэша поиска
+                return session.pack(db_worker.cache.stats())
+            case "19":      # Счётчики сервера: запросы, байты, подключения, ожидания
+                return session.pack(db_worker.metrics.snapshot())
+            case "11":      # Страница списка по курсору, в ответ - [названия, курсор]
+                return session.pack(list(db_worker.get_book_page(*page_args(args[1:]))))
+            case "12":      # Страница поиска, в ответ - [книги, курсор]
+                return session.pack(list(db_worker.find_books_page(args[1],
+                                                                   *page_args(args[2:]))))
+            case "13":      # Список названий частями, последняя часть пустая
+                return stream_data(db_worker.iter_book_list(), session.pack)
+            case "14":      # Результаты поиска частями
+                return stream_data(db_worker.iter_found_books(args[1]),
+                                   session.pack)
             case "3":
-                if not CLIENT_LOCK: # Если подключение не заблокировано, выполняем действия
-                    data = json.loads(command.split(CMD_SEP)[1])
-                    added = db_worker.add_book(data)
-                    send_bool(cl_sock, added)
-                else:               # Иначе сообщаем о неудаче
-                    send_bool(cl_sock, False)
-            case "4":
-                if not CLIENT_LOCK:
-                    book_name = command.split(CMD_SEP)[1]
-                    index = int(command.split(CMD_SEP)[2])
-                    string = command.split(CMD_SEP)[3]
-                    edited = db_worker.edit_book(book_name, index, string)
-                    send_bool(cl_sock, edited)
-                else:
-                    send_bool(cl_sock, False)
+                return pack_bool(db_worker.add_book(parse_book(data)))
+            case "7":       # Массовое добавление, в ответ - число принятых и отклонённых
+                if not isinstance(data, list):
+                    raise ValueError("нужен список книг")
+                return session.pack(list(db_worker.add_books(map(parse_book, data))))
+            case "8":       # Пачка операций, в ответ - список результатов по порядку
+                return session.pack(db_worker.batch(data["ops"],
+                                                    data.get("atomic", False)))
+            case "4":       # Последним аргументом можно передать версию книги из 16
+                return pack_bool(db_worker.edit_book(args[1], int(args[2]), args[3],
+                                                     version_arg(args[4:])))
             case "5":
-                if not CLIENT_LOCK:
-                    book_name = command.split(CMD_SEP)[1]
-                    removed = db_worker.remove_book(book_name)
-                    send_bool(cl_sock, removed)
-                else:
-                    send_bool(cl_sock, False)
+                return pack_bool(db_worker.remove_book(args[1], version_arg(args[2:])))
+            case "6" if len(args) > 2: # У книги своя версия, поэтому изменение других
+                book, version = db_worker.get_book_version(args[1]) # книг её не задевает
+                return conditional(session, version, version_arg(args[2:]), lambda: book)
             case "6":
-                book_name = command.split(CMD_SEP)[1]
-                book = db_worker.get_book(book_name)
-                send_data(cl_sock, book)
-            case "10": # Команда блокировки подключения, если оно ещё не заблокировано
-                if not CLIENT_LOCK:
-                    CLIENT_LOCK = cl_addr[1]
-                    send_bool(cl_sock, True)  # Сообщаем об успехе, если блокировка удалась
-                else:
-                    send_bool(cl_sock, False) # Иначе о неудаче
-            case "20": # Команда разблокировки подключения
-                if CLIENT_LOCK == cl_addr[1]: # Разблокировка доступна только тому клиенту,
-                                              # который соединение заблокировал
-                    CLIENT_LOCK = 0
+                return session.pack(db_worker.get_book(args[1]))
+            case "40":      # Подписка на изменения, дальше подключение только слушает
+                return db_worker.subscribe()
+            case "16":      # Книга с версией: [книга, версия]
+                return session.pack(list(db_worker.get_book_version(args[1])))
+            case "30": # Рукопожатие: параметры подключения, например codec=binary
+                       # или compression=zlib
+                return pack_bool(session.configure(args[1:]))
+            case "10": # Блокировки всего сервера больше нет, её заменили версии книг.
+                return pack_bool(True) # Старые клиенты по-прежнему получают успех
+            case "20":
+                return b""
             case "0":
-                running = False
-                print(cl_addr[1], "соединение разорвано клиентом", sep=": ")
-            case _:
-                bad_req_count += 1 # Если клиент отправляет что-то невразумительное,
-                                   # увеличиваем счётчик его плохих запросов
-                if bad_req_count == MAX_BAD_REQ_COUNT:
-                    running = False
-                    print(cl_addr[1], "соединение разорвано сервером", sep=": ")
-    cl_sock.close() # По завершении работы закрываем подключение
-
-
-db_worker = DBWorker("books.txt")    # Создание "работника" с книгами
-sock = socket.socket()               # Создание сокета
-sock.bind(("localhost", PORT))       # Прибивание порта к сокету
-sock.listen(1)                       # Единовременно может подключиться лишь один
-while True:                          # клиент, но их максимальное число не ограничено
-    cl_sock, cl_addr = sock.accept() # В цикле принимаем подключения
-    t = threading.Thread(target=work_thread, # И для каждого создаём по потоку
-                         args=(cl_sock, cl_addr, db_worker))
-    t.start()                        # Этот поток запускаем
+                session.running = False
+                log.info("%s: соединение разорвано клиентом", session.port)
+                return b""
+    except VersionConflict:
+        return bytes([CONFLICT])
+    except (IndexError, KeyError, TypeError, ValueError):
+        pass
+    session.bad_req_count += 1 # Если клиент отправляет что-то невразумительное,
+                               # увеличиваем счётчик его плохих запросов
+    if session.bad_req_count == MAX_BAD_REQ_COUNT:
+        session.running = False
+        log.info("%s: соединение разорвано сервером", session.port)
+    return BAD_REQUEST
+
+
+class Connection: # Подключение клиента: сокет, сессия и ещё не разобранные байты
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.session = Session(addr[1])
+        self.frames = FrameBuffer()
+        self.last_active = time.monotonic()
+
+    def serve(self, db_worker):
+        """
+        Одна порция работы: читаем то, что пришло (сокет уже готов к чтению),
+        выполняем все пришедшие целиком команды по порядку и отправляем ответы в
+        том же порядке. Клиент может прислать несколько запросов, не дожидаясь
+        ответов. Сами команды выполняет handle_command.
+        Если клиент подписался на изменения, возвращает его подписку: команды после
+        подписки не выполняются, а события отправляет push
+        """
+        session = self.session
+        self.last_active = time.monotonic()
+        try:
+            data = self.sock.recv(CHUNK_SIZE)
+            commands = self.frames.feed(data)
+        except (OSError, ValueError):        # Обрыв связи или испорченный размер запроса
+            session.running = False
+            return
+        if not data:
+            log.info("%s: соединение закрыто клиентом", session.port)
+            session.running = False
+            return
+        responses = list()
+        try:
+            for command in commands:
+                response = handle_command(command, session, db_worker)
+                if isinstance(response, bytes):
+                    responses.append(response)
+                elif isinstance(response, Subscription):
+                    self.sock.sendall(b"".join(responses))
+                    return response
+                else:                        # Потоковый ответ отправляется по частям
+                    self.sock.sendall(b"".join(responses))
+                    responses = list()
+                    for chunk in response:
+                        self.sock.sendall(chunk)
+                if not session.running:
+                    break
+            if any(responses):
+                self.sock.sendall(b"".join(responses))
+        except OSError:                      # Клиент отключился, не дождавшись ответа,
+            session.running = False          # или слишком долго его не забирает
+
+    def push(self, subscription, db_worker):
+        """
+        Отправка событий подписчику пачками по мере появления, а если событий нет
+        HEARTBEAT секунд - пустой пачки. Заканчивается, когда клиент отключился,
+        не успевал забирать события (тогда последним уходит "resync") или не
+        забирал пачку дольше IO_TIMEOUT
+        """
+        try:
+            while True:
+                events = subscription.wait(HEARTBEAT)
+                if subscription.overflowed:
+                    events.append(["resync", None, None, db_worker.catalogue_version])
+                self.sock.sendall(self.session.pack(events))
+                if subscription.overflowed:
+                    break
+        except OSError:
+            pass
+        finally:
+            db_worker.unsubscribe(subscription)
+            self.session.running = False
+
+
+class ConnectionPool:
+    """
+    Вместо потока на каждого клиента - постоянное число потоков. Главный поток
+    через selectors ждёт данные сразу от всех подключений и отдаёт подключение, в
+    которое что-то пришло, в очередь пулу. Пока поток пула его обслуживает,
+    подключение не слушается, поэтому команды одного клиента выполняются по
+    порядку. Потом поток возвращает подключение главному, а тот будится через
+    пару сокетов и снова начинает его слушать. Сверх max_connections клиенты
+    получают ответ BUSY_RESPONSE и отключаются, а молчащие дольше idle_timeout
+    секунд отключаются сами, поэтому перегрузка не съедает память и потоки.
+    Подписчику (команда 40) нужно ждать событий сколько угодно, поэтому его
+    подключение уходит из пула в отдельный поток и возвращается главному, только
+    чтобы закрыться
+    """
+    def __init__(self, sock, db_worker, workers=WORKERS,
+                 max_connections=MAX_CONNECTIONS, idle_timeout=IDLE_TIMEOUT):
+        self.sock = sock
+        self.db_worker = db_worker
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.__selector = selectors.DefaultSelector()
+        self.__ready = queue.Queue()              # Подключения, в которые пришли данные
+        self.__served = queue.Queue()             # Обслуженные, их снова нужно слушать
+        self.__connections = set()                # Все открытые, меняет только главный
+        self.__wakeup, self.__waker = socket.socketpair() # Будильник главного потока
+        for _ in range(workers):
+            threading.Thread(target=self.__worker, daemon=True).start()
+
+    def __worker(self):
+        """
+        Ошибка при выполнении команды (например, хранилище не приняло книгу) не
+        должна убивать поток пула: подключение с ней закрывается и всё равно
+        возвращается главному потоку, иначе оно навсегда заняло бы место в
+        max_connections
+        """
+        while True:
+            connection = self.__ready.get()
+            try:
+                subscription = connection.serve(self.db_worker)
+            except Exception:
+                log.exception("%s: ошибка при выполнении запроса", connection.session.port)
+                connection.session.running = False
+                subscription = None
+            if subscription is not None:
+                threading.Thread(target=self.__push, args=(connection, subscription),
+                                 daemon=True).start()
+                continue
+            self.__served.put(connection)
+            self.__waker.send(b"\0")
+
+    def __push(self, connection, subscription):
+        try:
+            connection.push(subscription, self.db_worker)
+        except Exception:
+            log.exception("%s: ошибка при отправке событий", connection.session.port)
+            connection.session.running = False
+        self.__served.put(connection)
+        self.__waker.send(b"\0")
+
+    def __accept(self):
+        try:
+            cl_sock, cl_addr = self.sock.accept()
+        except OSError:                           # Клиент ушёл, не дождавшись принятия
+            return
+        if len(self.__connections) >= self.max_connections:
+            log.warning("%s: сервер занят, соединение отклонено", cl_addr[1])
+            self.db_worker.metrics.connection_rejected()
+            try:
+                cl_sock.send(BUSY_RESPONSE)
+            except OSError:
+                pass
+            cl_sock.close()
+            return
+        cl_sock.settimeout(IO_TIMEOUT)
+        connection = Connection(cl_sock, cl_addr)
+        self.__connections.add(connection)
+        self.__selector.register(cl_sock, selectors.EVENT_READ, connection)
+        self.db_worker.metrics.connection_opened()
+        log.info("%s: соединение установлено", cl_addr[1])
+
+    def __close(self, connection):
+        self.__connections.discard(connection)
+        connection.sock.close()
+        self.db_worker.metrics.connection_closed()
+
+    def __close_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        for key in list(self.__selector.get_map().values()):
+            connection = key.data
+            if connection is not None and connection.last_active < deadline:
+                log.info("%s: соединение закрыто по простою", connection.session.port)
+                self.__selector.unregister(key.fileobj)
+                self.__close(connection)
+
+    def serve_forever(self):
+        self.sock.setblocking(False)
+        self.__selector.register(self.sock, selectors.EVENT_READ)
+        self.__selector.register(self.__wakeup, selectors.EVENT_READ)
+        while True:
+            for key, _ in self.__selector.select(timeout=1):
+                if key.fileobj is self.sock:
+                    self.__accept()
+                elif key.fileobj is self.__wakeup:
+                    self.__wakeup.recv(CHUNK_SIZE)
+                else:                             # Пока подключение обслуживается,
+                    self.__selector.unregister(key.fileobj) # его не слушаем
+                    self.__ready.put(key.data)
+            while not self.__served.empty():
+                connection = self.__served.get()
+                if connection.session.running:
+                    self.__selector.register(connection.sock, selectors.EVENT_READ,
+                                             connection)
+                else:
+                    self.__close(connection)
+            self.__close_idle()
+
+
+def build_parser(description):               # Параметры запуска, общие для обоих серверов
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--db", default=DB_FILE,
+                        help="файл с книгами: текстовый или база SQLite (.db)")
+    parser.add_argument("--durability", default=DURABILITY,
+                        choices=("sync", "group", "async"),
+                        help="когда подтверждать запись клиенту")
+    parser.add_argument("--commit-interval", type=int, default=COMMIT_INTERVAL,
+                        help="период групповой записи в миллисекундах")
+    parser.add_argument("--query-cache", type=int, default=QUERY_CACHE_SIZE,
+                        help="сколько результатов поиска помнить, 0 - не помнить")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="сколько клиентов принимать, остальным ответ \"занят\"")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="через сколько секунд молчания отключать клиента")
+    parser.add_argument("--log-level", default=LOG_LEVEL,
+                        choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                        help="подробность журнала, DEBUG - каждый запрос")
+    parser.add_argument("--metrics-file",
+                        help="файл, в который дописывать счётчики строками json")
+    parser.add_argument("--metrics-interval", type=float, default=METRICS_INTERVAL,
+                        help="раз во сколько секунд дописывать счётчики")
+    return parser
+
+def setup_logging(level):
+    """
+    Журнал пишется через очередь: поток, который обслуживает клиента, только кладёт
+    запись в очередь, а в консоль её выводит отдельный поток. Так медленный вывод
+    не задерживает ответы. Возвращает слушателя очереди, его нужно остановить при
+    завершении, чтобы дописать оставшиеся записи
+    """
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    log.addHandler(logging.handlers.QueueHandler(records))
+    log.setLevel(level)
+    log.propagate = False
+    return listener
+
+def create_db_worker(args):
+    return DBWorker(args.db,                 # Создание "работника" с книгами. Изменения
+                    journal=True,            # дописываются в журнал books.txt.log, а книги
+                    lazy=True,               # читаются из файла по мере обращения к ним
+                    durability=args.durability,
+                    commit_interval=args.commit_interval,
+                    query_cache=args.query_cache)
+
+def start_metrics_dump(db_worker, args):     # Счётчики в файл, если он указан
+    if args.metrics_file:
+        db_worker.metrics.dump_every(args.metrics_file, args.metrics_interval)
+
+
+def listen(port):
+    sock = socket.socket()               # Создание сокета
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # Порт свободен сразу
+    sock.bind(("localhost", port))       # после перезапуска. Прибивание порта к сокету
+    sock.listen(BACKLOG)
+    return sock
+
+
+def main():
+    parser = build_parser("Сервер библиотеки")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="сколько потоков обслуживает клиентов")
+    args = parser.parse_args()
+    listener = setup_logging(args.log_level)
+    db_worker = create_db_worker(args)
+    start_metrics_dump(db_worker, args)
+    sock = listen(PORT)
+    pool = ConnectionPool(sock, db_worker, args.workers, # Подключения обслуживает
+                          args.max_connections,          # постоянный пул потоков
+                          args.idle_timeout)
+    try:
+        pool.serve_forever()
+    except KeyboardInterrupt:            # При остановке по CTRL+C дописываем на диск
+        db_worker.close()                # изменения, которые ещё стоят в очереди
+    finally:
+        listener.stop()
+
+
+if __name__ == "__main__":               # Сервер запускается, только если запущен этот файл,
+    main()                               # а не импортирован, например, генератором данных
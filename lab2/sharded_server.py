@@ -0,0 +1,510 @@
+"""
+Сервер из нескольких процессов. Из-за GIL server.py занимает одно ядро, сколько бы
+потоков у него ни было, а поиск - это работа на питоне. Здесь каталог делится по
+crc32 названия на --shards частей (шардов), и каждую держит свой процесс со своим
+DBWorker и своим файлом: books.shard0.txt, books.shard1.txt и так далее. Шард - это
+обычный сервер из server.py на своём порту (--shard-port, --shard-port+1, ...), а
+клиенты подключаются к роутеру на обычный порт. Роутер понимает те же команды:
+книгу (3-6, 16) он отправляет шарду, которому принадлежит её название, а список и
+поиск (1, 2) - всем шардам разом и склеивает ответы, поэтому поиск идёт на всех
+ядрах параллельно.
+При первом запуске каталог из --db раскладывается по файлам шардов, дальше работа
+идёт только с ними, а исходный файл не меняется.
+Общих транзакций у шардов нет:
+- переименование, после которого книга принадлежит другому шарду, - это
+  добавление в новый шард и удаление из старого, и на мгновение книга видна под
+  обоими названиями. Изменения обоих названий в это время ждут: роутер держит
+  мьютексы названий, которые меняет
+- атомарная пачка (команда 8) проходит, только если все её изменения приходятся на
+  один шард, иначе она отклоняется так же, как не прошедшая проверку
+Запуск: python sharded_server.py --shards 4 (остальные параметры те же, что у server.py)
+"""
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+import zlib
+from argparse import Namespace
+from contextlib import ExitStack
+from itertools import chain, islice
+from types import SimpleNamespace
+from client_lib import HOST, RETRIES, RETRY_DELAY, TIMEOUT, MessengerPool
+from metrics import Metrics
+from server import CONFLICT, DATA_COMMANDS, PAGE_SIZE, PORT, STREAM_CHUNK, \
+                   SUBSCRIBER_QUEUE, WORKERS, ConnectionPool, DBWorker, Subscription, \
+                   VersionConflict, build_parser, create_db_worker, listen, log, pack_data, \
+                   parse_batch_op, setup_logging, start_metrics_dump
+from storage import BOOK_FIELDS, open_storage
+
+SHARDS = os.cpu_count() or 1 # По шарду на ядро
+SHARD_PORT = PORT + 1      # Шарды слушают порты подряд начиная с этого
+SHARD_CODEC = "binary"     # Списки книг и названий двоичный кодек пакует и разбирает
+                           # быстрее json, а роутер разбирает каждый ответ шарда
+START_TIMEOUT = 60         # Сколько секунд ждать, пока шарды загрузят каталог
+STOP_TIMEOUT = 10          # Сколько секунд ждать, пока шард допишет изменения на диск
+CHANGES = ("add", "edit", "remove") # Операции пачки, которые меняют каталог
+TITLE_LOCKS = 64           # На сколько мьютексов делятся названия в роутере
+
+
+def title_hash(title):     # crc32, а не hash(): hash строк в каждом процессе свой
+    if not isinstance(title, str):
+        raise TypeError("название должно быть строкой")
+    return zlib.crc32(title.encode("utf-8"))
+
+def shard_of(title, shards):                 # Номер шарда, которому принадлежит книга
+    return title_hash(title) % shards
+
+def shard_filename(filename, number):        # books.txt -> books.shard0.txt
+    base, ext = os.path.splitext(filename)
+    return f"{base}.shard{number}{ext}"
+
+def split_catalogue(filename, shards):
+    """
+    Раскладывает каталог по файлам шардов, если это ещё не сделано. Каталог
+    читается вместе с журналом, как в migrate.py. Если файлы есть не у всех шардов
+    или есть лишний, каталог раньше разбили на другое число частей. Разбивать его
+    заново нельзя: в файлах шардов могут быть изменения, которых нет в исходном
+    """
+    names = [shard_filename(filename, number) for number in range(shards)]
+    existing = [os.path.exists(name) for name in names]
+    extra = os.path.exists(shard_filename(filename, shards))
+    if all(existing) and not extra:
+        return
+    if any(existing) or extra:
+        sys.exit(f"Каталог {filename} уже разбит на другое число шардов")
+    groups = [list() for _ in range(shards)]
+    for book in DBWorker(filename, journal=True, lazy=True).books:
+        groups[shard_of(book[0], shards)].append(book)
+    for name, books in zip(names, groups):
+        open_storage(name).save(books)
+    log.info("Каталог %s разбит на %s шардов", filename, shards)
+
+
+def run_shard(args, number, started, stop):
+    """
+    Процесс шарда: обычный сервер из server.py над своим файлом и на своём порту
+    """
+    listener = setup_logging(args.log_level)
+    db_worker = create_db_worker(Namespace(**{**vars(args),
+                                              "db": shard_filename(args.db, number)}))
+    sock = listen(args.shard_port + number)
+    threading.Thread(target=stop_with_router, args=(db_worker, stop), daemon=True).start()
+    started.put(number)
+    try:
+        ConnectionPool(sock, db_worker, args.workers, args.max_connections,
+                       args.idle_timeout).serve_forever()
+    except KeyboardInterrupt:            # CTRL+C получают все процессы разом
+        db_worker.close()
+    finally:
+        listener.stop()
+
+def stop_with_router(db_worker, stop):
+    """
+    Шард живёт, пока открыт канал от роутера. Роутер закрывает его при остановке,
+    а если роутер упал, канал закрывает система. Тогда шард дописывает очередь
+    изменений на диск и завершается
+    """
+    try:
+        stop.recv()
+    except EOFError:
+        pass
+    db_worker.close()
+    os._exit(0)
+
+def start_shards(args):
+    """
+    Шарды запускаются как новые процессы (spawn), а не копии роутера, чтобы им не
+    достались его потоки и сокеты. Возвращает процессы и канал, закрытие которого
+    их останавливает
+    """
+    context = multiprocessing.get_context("spawn")
+    started = context.Queue()
+    stop, stop_sender = context.Pipe(duplex=False)
+    shards = [context.Process(target=run_shard, args=(args, number, started, stop),
+                              name=f"shard{number}")
+              for number in range(args.shards)]
+    for shard in shards:
+        shard.start()
+    deadline = time.monotonic() + START_TIMEOUT
+    ready = 0
+    while ready < len(shards):
+        try:
+            started.get(timeout=1)
+            ready += 1
+        except queue.Empty:
+            if time.monotonic() > deadline or not all(shard.is_alive() for shard in shards):
+                stop_shards(shards, stop_sender)
+                sys.exit("Шарды не запустились")
+    return shards, stop_sender
+
+def stop_shards(shards, stop_sender):
+    stop_sender.close()
+    for shard in shards:
+        shard.join(STOP_TIMEOUT)
+        if shard.is_alive():
+            shard.terminate()
+
+
+class RouterMetrics(Metrics): # Счётчики роутера, а в поле shards - каждого шарда
+    def __init__(self, shard_snapshots):
+        super().__init__()
+        self.shard_snapshots = shard_snapshots
+
+    def snapshot(self):
+        return {**super().snapshot(), "shards": self.shard_snapshots()}
+
+
+class ShardRouter:
+    """
+    То, что сервер из server.py ждёт от DBWorker, только книги лежат в шардах.
+    Поэтому роутер - это тот же ConnectionPool и handle_command, а каждый метод
+    здесь - запросы к шардам через пулы подключений. Все изменения проходят через
+    роутер, поэтому версию каталога для условных запросов и подписки он ведёт сам
+    """
+    def __init__(self, ports, pool_size, timeout=TIMEOUT):
+        self.metrics = RouterMetrics(lambda: self.__everywhere("19"))
+        self.cache = SimpleNamespace(stats=self.__cache_stats) # Кэши поиска шардов
+        self.shards = [MessengerPool(HOST, port, pool_size, timeout, codec=SHARD_CODEC)
+                       for port in ports]
+        self.__lock = threading.Lock()            # Версия каталога и подписчики
+        self.__title_locks = [threading.Lock() for _ in range(TITLE_LOCKS)]
+        self.__last_version = time.time_ns()
+        self.__subscribers = set()
+        self.__lists = [(None, [])] * len(ports)  # Версия и список названий каждого шарда
+
+    def __number(self, title):
+        return shard_of(title, len(self.shards))
+
+    def __shard(self, title):
+        return self.shards[self.__number(title)]
+
+    def __locked(self, *titles):
+        """
+        Мьютексы названий на время изменения, по мьютексу на группу названий. Без
+        них переименование в другой шард могло бы столкнуться с изменением любого
+        из двух названий, пока книга лежит в обоих шардах. Мьютексы берутся по
+        порядку номеров, чтобы изменения не ждали друг друга по кругу
+        """
+        stack = ExitStack()
+        for number in sorted({title_hash(title) % TITLE_LOCKS for title in titles}):
+            stack.enter_context(self.__title_locks[number])
+        return stack
+
+    def __gather(self, requests, idempotent=True):
+        """
+        Запросы к нескольким шардам: {номер шарда: (команда, аргументы)}. Все
+        запросы отправляются до того, как читается первый ответ, поэтому шарды
+        выполняют их параллельно. Подключения берутся по порядку номеров шардов,
+        чтобы потоки роутера не ждали друг друга по кругу. Возвращает ответы по
+        номерам шардов
+        """
+        for attempt in range(RETRIES + 1):
+            sent = False
+            try:
+                with ExitStack() as stack:
+                    messengers = {number: stack.enter_context(self.shards[number].connection())
+                                  for number in sorted(requests)}
+                    for number, (command, args) in requests.items():
+                        if command in DATA_COMMANDS:
+                            messengers[number].send_data(command, args)
+                        else:
+                            messengers[number].send_command(command, *args)
+                    sent = True
+                    return {number: messenger.get_data()
+                            for number, messenger in messengers.items()}
+            except TimeoutError:
+                raise
+            except OSError:
+                if (sent and not idempotent) or attempt == RETRIES:
+                    raise
+            time.sleep(RETRY_DELAY * 2**attempt)
+
+    def __everywhere(self, command, *args):   # Один запрос всем шардам, ответы по порядку
+        responses = self.__gather({number: (command, args)
+                                   for number in range(len(self.shards))})
+        return [responses[number] for number in range(len(self.shards))]
+
+    def __cache_stats(self):
+        stats = self.__everywhere("9")
+        return {key: sum(shard[key] for shard in stats) for key in stats[0]}
+
+    @property
+    def catalogue_version(self):
+        return self.__last_version
+
+    def __changed(self, kind, title, index=None, *extra):
+        """
+        Вызывается после изменения в шарде: новая версия каталога и событие для
+        подписчиков, как у DBWorker
+        """
+        with self.__lock:
+            self.__last_version += 1
+            event = [kind, title, index, self.__last_version, *extra]
+            for subscription in list(self.__subscribers):
+                subscription.publish(event)
+                if subscription.overflowed:
+                    self.__subscribers.discard(subscription)
+
+    def subscribe(self, size=SUBSCRIBER_QUEUE):
+        subscription = Subscription(size)
+        with self.__lock:
+            subscription.publish(["subscribed", None, None, self.__last_version])
+            self.__subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.__lock:
+            self.__subscribers.discard(subscription)
+
+    def get_book_list(self):
+        """
+        Списки названий шардов склеиваются. Роутер помнит последний список каждого
+        шарда и спрашивает его условно (команда 1 с версией), поэтому шард, в
+        котором ничего не поменялось, отвечает четырьмя байтами
+        """
+        lists = self.__lists
+        responses = self.__gather({number: ("1", ["" if version is None else str(version)])
+                                   for number, (version, _) in enumerate(lists)})
+        lists = [lists[number] if responses[number] is None else
+                 (responses[number][1], responses[number][0]) for number in range(len(lists))]
+        self.__lists = lists
+        return list(chain.from_iterable(titles for _, titles in lists))
+
+    def find_books(self, string):
+        return list(chain.from_iterable(self.__everywhere("2", string)))
+
+    def find_books_packed(self, string, codec, compression="none"):
+        return pack_data(self.find_books(string), codec, compression)
+
+    def __page(self, fetch, cursor, limit):
+        """
+        Страница по всем шардам: сначала книги первого шарда, потом второго и так
+        далее. В курсоре роутера зашиты номер шарда и курсор внутри него:
+        (курсор шарда + 1) * число шардов + номер шарда, где курсор -1 - начало шарда
+        """
+        shards = len(self.shards)
+        if cursor is not None and cursor < 0:
+            raise ValueError("неверный курсор")
+        number, local = (0, -1) if cursor is None else (cursor % shards, cursor//shards - 1)
+        items = list()
+        while number < shards and len(items) < limit:
+            with self.shards[number].connection() as messenger:
+                page, local = fetch(messenger, None if local < 0 else local,
+                                    limit - len(items))
+            items += page
+            if local is not None:
+                return items, (local + 1) * shards + number
+            number, local = number + 1, -1
+        return items, None if number == shards else number
+
+    def get_book_page(self, cursor=None, limit=PAGE_SIZE):
+        return self.__page(lambda messenger, *page: messenger.get_book_page(*page),
+                           cursor, limit)
+
+    def find_books_page(self, string, cursor=None, limit=PAGE_SIZE):
+        return self.__page(lambda messenger, *page: messenger.find_books_page(string, *page),
+                           cursor, limit)
+
+    def __stream(self, items, chunk):          # Выдача шардов по очереди частями
+        for shard in self.shards:
+            with shard.connection() as messenger:
+                stream = items(messenger)
+                while part := list(islice(stream, chunk)):
+                    yield part
+
+    def iter_book_list(self, chunk=STREAM_CHUNK):
+        return self.__stream(lambda messenger: messenger.iter_book_list(), chunk)
+
+    def iter_found_books(self, string, chunk=STREAM_CHUNK):
+        return self.__stream(lambda messenger: messenger.iter_found_books(string), chunk)
+
+    def get_book(self, book_name):
+        return self.__shard(book_name).get_book(book_name)
+
+    def get_book_version(self, book_name):
+        return self.__shard(book_name).get_book_version(book_name)
+
+    @staticmethod
+    def __checked(result, book_name):        # Ответ шарда на изменение с версией
+        if result == CONFLICT:
+            raise VersionConflict(book_name)
+        return bool(result)
+
+    def add_book(self, data):
+        if len(data) != len(BOOK_FIELDS):
+            return False
+        with self.__locked(data[0]):
+            if not self.__shard(data[0]).add_book(data):
+                return False
+            self.__changed("add", data[0])
+        return True
+
+    def add_books(self, books):
+        results = self.batch([["add", book] for book in books])
+        return results.count(True), results.count(False)
+
+    def __moves(self, book_name, string):    # Переименование в чужой шард
+        return string != book_name and self.__number(string) != self.__number(book_name)
+
+    def __move(self, book_name, string, version=None):
+        """
+        Переименование, после которого книга принадлежит другому шарду: книга
+        добавляется в новый шард под новым названием и удаляется из старого.
+        Вызывается под мьютексами обоих названий, поэтому книгу в это время никто
+        не меняет. Удаление всё равно идёт с прочитанной версией, и если оно не
+        прошло, копия убирается
+        """
+        source, target = self.__shard(book_name), self.__shard(string)
+        book, current = source.get_book_version(book_name)
+        if not book:
+            return False
+        if version is not None and current != version:
+            raise VersionConflict(book_name)
+        if not target.add_book([string, *book[1:]]):
+            return False
+        if source.remove_book(book_name, current) != 1:
+            target.remove_book(string)
+            return False
+        return True
+
+    def edit_book(self, book_name, index, string, version=None):
+        if not 0 <= index < len(BOOK_FIELDS):
+            raise IndexError("неверный номер поля")
+        with self.__locked(*self.__op_titles(["edit", book_name, index, string])):
+            if index == 0 and self.__moves(book_name, string):
+                done = self.__move(book_name, string, version)
+            else:
+                done = self.__checked(self.__shard(book_name).edit_book(
+                                          book_name, index, string, version), book_name)
+            if done:
+                self.__publish_op(["edit", book_name, index, string])
+        return done
+
+    def remove_book(self, book_name, version=None):
+        with self.__locked(book_name):
+            done = self.__checked(self.__shard(book_name).remove_book(book_name, version),
+                                  book_name)
+            if done:
+                self.__changed("remove", book_name)
+        return done
+
+    def __publish_op(self, op):                # Событие об изменении из операции пачки
+        match op:
+            case ["add", book]:
+                self.__changed("add", book[0])
+            case ["edit", book_name, 0, string] if string != book_name:
+                self.__changed("edit", string, 0, book_name)
+            case ["edit", book_name, index, _]:
+                self.__changed("edit", book_name, index)
+            case ["remove", book_name]:
+                self.__changed("remove", book_name)
+
+    @staticmethod
+    def __op_titles(op):                      # Названия, которые меняет операция пачки
+        match op:
+            case ["add", book]:
+                return [book[0] if book else ""]
+            case ["edit", book_name, 0, string]:
+                return [book_name, string]
+            case ["edit" | "remove", book_name, *_]:
+                return [book_name]
+        return []
+
+    def __op_shard(self, op):
+        if op[0] == "add":
+            return self.__number(op[1][0] if op[1] else "")
+        return self.__number(op[1])
+
+    def __batch_part(self, ops, atomic):
+        """
+        Часть пачки без переноса между шардами. Каждый шард получает свои операции
+        в том же порядке одной пачкой, поиск получают все шарды, и шарды выполняют
+        свои пачки параллельно
+        """
+        parts = dict()                           # Номер шарда -> операции и их места
+        for index, op in enumerate(ops):
+            numbers = range(len(self.shards)) if op[0] == "find" else [self.__op_shard(op)]
+            for number in numbers:
+                part_ops, places = parts.setdefault(number, (list(), list()))
+                part_ops.append(op)
+                places.append(index)
+        changes = any(op[0] in CHANGES for op in ops)
+        responses = self.__gather({number: ("8", {"ops": part_ops, "atomic": atomic})
+                                   for number, (part_ops, _) in parts.items()},
+                                  idempotent=not changes)
+        results = [list() if op[0] == "find" else None for op in ops]
+        for number in sorted(parts):
+            for index, result in zip(parts[number][1], responses[number]):
+                if ops[index][0] == "find":
+                    results[index] += result
+                else:
+                    results[index] = result
+        return results
+
+    def batch(self, ops, atomic=False):
+        """
+        Пачка делится на части переименованиями в чужой шард: они выполняются
+        отдельно, а части до и после них - параллельно во всех нужных шардах.
+        Атомарная пачка проходит, только если все её изменения приходятся на один
+        шард, иначе все результаты - False, как у не прошедшей проверку
+        """
+        ops = [parse_batch_op(op) for op in ops]
+        moves = [index for index, op in enumerate(ops)
+                 if op[0] == "edit" and op[2] == 0 and self.__moves(op[1], op[3])]
+        if atomic and (moves or len({self.__op_shard(op) for op in ops
+                                     if op[0] in CHANGES}) > 1):
+            return [False] * len(ops)
+        results, start = list(), 0
+        with self.__locked(*chain.from_iterable(self.__op_titles(op) for op in ops)):
+            for end in moves + [len(ops)]:
+                if start < end:
+                    results += self.__batch_part(ops[start:end], atomic)
+                if end < len(ops):
+                    results.append(self.__move(ops[end][1], ops[end][3]))
+                start = end + 1
+            if atomic and not all(result for op, result in zip(ops, results)
+                                  if op[0] in CHANGES):
+                return [False] * len(ops)
+            for op, result in zip(ops, results):
+                if op[0] in CHANGES and result:
+                    self.__publish_op(op)
+        return results
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
+def main():
+    parser = build_parser("Сервер библиотеки из нескольких процессов")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="сколько потоков обслуживает клиентов в роутере и в шарде")
+    parser.add_argument("--shards", type=int, default=SHARDS,
+                        help="на сколько процессов делить каталог")
+    parser.add_argument("--shard-port", type=int, default=SHARD_PORT,
+                        help="порт первого шарда, у остальных - следующие")
+    args = parser.parse_args()
+    if args.shards < 1:
+        parser.error("нужен хотя бы один шард")
+    listener = setup_logging(args.log_level)
+    split_catalogue(args.db, args.shards)
+    shards, stop_sender = start_shards(args)
+    log.info("Шарды запущены на портах %s-%s", args.shard_port,
+             args.shard_port + args.shards - 1)
+    router = ShardRouter([args.shard_port + number for number in range(args.shards)],
+                         args.workers)
+    start_metrics_dump(router, args)
+    try:
+        ConnectionPool(listen(PORT), router, args.workers, args.max_connections,
+                       args.idle_timeout).serve_forever()
+    except KeyboardInterrupt:
+        router.close()
+    finally:
+        stop_shards(shards, stop_sender)
+        listener.stop()
+
+
+if __name__ == "__main__":
+    main()
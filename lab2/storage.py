@@ -0,0 +1,422 @@
+"""
+Хранилища книг для DBWorker. Сам DBWorker держит книги и индексы в памяти, а хранилище
+отвечает только за то, как книги попадают на диск и обратно:
+- TextStorage - прежний файл books.txt по 11 строк на книгу, с журналом изменений
+  и ленивым чтением через отображение файла в память
+- SQLiteStorage - база SQLite, где каждое изменение - отдельная короткая транзакция
+Оба хранилища понимают одни и те же записи об изменениях: ["add", книга],
+["edit", название, номер строки, значение] и ["remove", название]
+"""
+import os                  # Нужна для проверки и замены файлов
+import re                  # Нужна для разбора дат при упаковке книг
+import sys                 # Нужна для интернирования повторяющихся строк
+import json                # Нужна для записи журнала
+import mmap                # Нужна для ленивого чтения файла с книгами
+import locale              # Нужна, чтобы декодировать файл так же, как это делает open
+import sqlite3             # Нужна для хранения книг в базе данных
+import threading           # Нужна для защиты соединения с базой
+from operator import attrgetter
+
+
+JOURNAL_LIMIT = 1000       # Сколько изменений копится в журнале до слияния со снимком
+BINDINGS = ("мягкий", "твёрдый")                  # Допустимые значения переплёта
+SOURCES = ("покупка", "подарок", "наследство")    # и источника, хранятся номером
+SQLITE_EXTENSIONS = (".db", ".sqlite", ".sqlite3") # Файлы с такими расширениями - базы SQLite
+DAYS = tuple(str(i) for i in range(100))          # Готовые строки дней и месяцев для
+PADDED_DAYS = tuple(f"{i:02}" for i in range(100)) # распаковки дат без и с ведущим нулём
+
+
+# Упаковка полей книги. Каждая пара функций переводит строку в компактное значение и
+# обратно без потерь: если строка не укладывается в компактную форму (например, "007"
+# или дата в другом формате), она хранится как есть
+def pack_number(value):
+    if value.isascii() and value.isdigit() and str(int(value)) == value:
+        return int(value)
+    return value
+
+def unpack_number(value):
+    return value if isinstance(value, str) else str(value)
+
+def pack_choice(choices):
+    def pack(value):
+        return choices.index(value) if value in choices else sys.intern(value)
+    return pack
+
+def unpack_choice(choices):
+    def unpack(value):
+        return value if isinstance(value, str) else choices[value]
+    return unpack
+
+def pack_date(value):
+    """
+    Дата "Д.М.ГГГГ" упаковывается в одно число ГГГГММДД, сдвинутое на два бита.
+    В младших битах запоминается, были ли у дня и месяца ведущие нули, чтобы
+    и "4.4.2005", и "04.04.2005" вернулись в том же виде
+    """
+    if not (match := re.match(r"^(\d{1,2})\.(\d{1,2})\.(\d{4})$", value)):
+        return value
+    day, month, year = match.groups()
+    return (((int(year)*100 + int(month))*100 + int(day)) << 2) | \
+           (len(day) == 2) << 1 | (len(month) == 2)
+
+def unpack_date(value):
+    if isinstance(value, str):
+        return value
+    date = value >> 2
+    day = (PADDED_DAYS if value & 2 else DAYS)[date % 100]
+    month = (PADDED_DAYS if value & 1 else DAYS)[date//100 % 100]
+    return f"{day}.{month}.{date//10000:04}"
+
+def keep(value):
+    return value
+
+
+class Book:
+    """
+    Компактная запись о книге. Вместо списка из 11 строк хранит поля в слотах:
+    год и размеры - числами, даты - упакованными числами, переплёт и источник -
+    номерами из BINDINGS и SOURCES, авторы и жанр - интернированными строками,
+    которые одни на все книги. Снаружи запись ведёт себя как прежний список:
+    book[i] возвращает строку, book[i] = строка упаковывает значение.
+    Строки собираются заново при каждом чтении и нигде не запоминаются, иначе
+    каждая прочитанная книга занимала бы памяти больше прежнего списка. Повторные
+    поиски целиком помнит QueryCache, а его размер ограничен
+    """
+    __slots__ = ("title", "authors", "genre", "year", "width", "height",
+                 "binding", "source", "added", "read", "review",
+                 "origin", "offset")                  # Откуда дочитать ленивую книгу
+    
+    def __init__(self, data):
+        self.origin = None
+        for (slot, pack, _), value in zip(BOOK_FIELDS, data):
+            setattr(self, slot, pack(value))
+    
+    @classmethod
+    def lazy(cls, title, origin, offset):
+        """
+        Ленивая книга: известно только название, остальные поля будут прочитаны из
+        origin (MappedFile или SQLiteStorage) по смещению offset при первом обращении
+        к любому из них
+        """
+        book = cls.__new__(cls)
+        book.title = title
+        book.origin = origin
+        book.offset = offset
+        return book
+    
+    def __getattr__(self, name):                      # Вызывается, только если слот не
+        if name in ("origin", "offset"):              # заполнен. Пока мы сюда шли, книгу
+            raise AttributeError(name)                # мог дочитать другой поток, тогда
+        self.load()                                   # load ничего не делает, а слот уже
+        return object.__getattribute__(self, name)    # заполнен
+    
+    def copy(self):
+        """
+        Копия, которую можно изменить, не трогая саму книгу. Ленивая книга сначала
+        дочитывается: ленивая копия осталась бы привязана к источнику, который
+        полная перезапись закрывает, дочитав только книги каталога
+        """
+        self.load()
+        book = Book.__new__(Book)
+        book.origin = None
+        for slot, _, _ in BOOK_FIELDS:
+            setattr(book, slot, getattr(self, slot))
+        return book
+    
+    def load(self):                                   # Дочитывает ленивую книгу целиком
+        origin = self.origin
+        if origin is None:
+            return
+        try:
+            data = origin.read(self.offset)
+        except ValueError:                            # Источник закрыли, пока мы читали,
+            if self.origin is None:                   # но перед этим полная перезапись
+                return                                # дочитала книгу сама
+            raise
+        for (slot, pack, _), value in zip(BOOK_FIELDS[1:], data[1:]):
+            setattr(self, slot, pack(value))
+        self.origin = None
+    
+    def __len__(self):
+        return len(BOOK_FIELDS)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.to_list()[index]
+        slot, _, unpack = BOOK_FIELDS[index]
+        return unpack(getattr(self, slot))
+    
+    def __setitem__(self, index, value):
+        self.load()                                   # Иначе чтение затрёт новое значение
+        slot, pack, _ = BOOK_FIELDS[index]
+        setattr(self, slot, pack(value))
+    
+    def __iter__(self):
+        return iter(self.to_list())
+    
+    def to_list(self):                            # Прежнее представление для файла и сети
+        return [unpack(value) for unpack, value in zip(UNPACKS, SLOTS(self))]
+
+
+BOOK_FIELDS = (                                   # Слот, упаковка и распаковка для каждой
+    ("title", keep, keep),                        # из 11 строк книги по порядку
+    ("authors", sys.intern, keep),
+    ("genre", sys.intern, keep),
+    ("year", pack_number, unpack_number),
+    ("width", pack_number, unpack_number),
+    ("height", pack_number, unpack_number),
+    ("binding", pack_choice(BINDINGS), unpack_choice(BINDINGS)),
+    ("source", pack_choice(SOURCES), unpack_choice(SOURCES)),
+    ("added", pack_date, unpack_date),
+    ("read", pack_date, unpack_date),
+    ("review", keep, keep),
+)
+SLOTS = attrgetter(*(slot for slot, _, _ in BOOK_FIELDS)) # Все слоты книги одним вызовом
+UNPACKS = tuple(unpack for _, _, unpack in BOOK_FIELDS)
+
+
+class MappedFile:
+    """
+    Файл с книгами, отображённый в память. При открытии ничего не читается:
+    records() один раз проходит по файлу и отдаёт только начала записей и названия,
+    а read() декодирует одну запись целиком, когда она действительно понадобилась
+    """
+    def __init__(self, filename):
+        self.file = open(filename, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.encoding = locale.getpreferredencoding(False)
+    
+    def __line(self, start, end):
+        return self.map[start:end].decode(self.encoding).removesuffix("\r")
+    
+    def records(self):
+        start = 0
+        while True:
+            title_end = end = self.map.find(b"\n", start)
+            for _ in range(10):                       # Пропускаем остальные 10 строк
+                if end < 0:
+                    break
+                end = self.map.find(b"\n", end+1)
+            if end < 0:                               # Недописанная запись в конце
+                return
+            yield start, self.__line(start, title_end)
+            start = end + 1
+    
+    def read(self, offset):
+        book = list()
+        for _ in range(len(BOOK_FIELDS)):
+            end = self.map.find(b"\n", offset)
+            book.append(self.__line(offset, end))
+            offset = end + 1
+        return book
+    
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+class TextStorage:
+    """
+    Книги в текстовом файле по 11 строк на книгу. Если включён журнал, изменения
+    дописываются одной строкой json в файл с расширением .log, а при запуске
+    применяются поверх снимка. Когда журнал дорастает до journal_limit записей, он
+    сливается в новый снимок. В ленивом режиме файл отображается в память и книги
+    дочитываются по требованию
+    """
+    def __init__(self, filename, journal=False, journal_limit=JOURNAL_LIMIT, lazy=False):
+        self.filename = filename
+        self.journal = journal
+        self.journal_name = filename + ".log"
+        self.journal_limit = journal_limit
+        self.lazy = lazy
+        self.__mapped = None
+        self.__journal_len = 0
+        self.__journal_file = None
+        if not os.path.exists(self.filename):
+            f = open(self.filename, "w")
+            f.close()
+    
+    def load(self):                               # Отдаёт книги из снимка по порядку
+        if self.lazy and os.path.getsize(self.filename):
+            self.__mapped = MappedFile(self.filename)
+            for offset, title in self.__mapped.records():
+                yield Book.lazy(title, self.__mapped, offset)
+            return
+        with open(self.filename, "r") as file:
+            lines = file.readlines()
+            for i in range(len(lines)//11):
+                book = list()
+                for j in range(11):
+                    book.append(lines[i*11+j][:-1])
+                yield Book(book)
+    
+    def replay(self):
+        """
+        Отдаёт изменения из журнала. Недописанная последняя строка (например, после
+        падения) пропускается
+        """
+        if not os.path.exists(self.journal_name):
+            return
+        with open(self.journal_name, "r") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                self.__journal_len += 1
+                yield record
+    
+    def replayed(self, books):                    # Если журнал слишком большой или режим
+        if self.__journal_len and \
+           (not self.journal or self.__journal_len >= self.journal_limit):
+            self.save(books())                    # журнала выключен, сливаем его сразу
+    
+    def save(self, books):
+        """
+        Снимок пишется во временный файл, который затем подменяет основной, поэтому
+        при сбое на диске остаётся либо старая, либо новая версия. Ленивые книги
+        дочитываются при записи, после чего отображение старого файла закрывается.
+        После записи снимка журнал больше не нужен и удаляется
+        """
+        with open(self.filename + ".tmp", "w") as file:
+            for book in books:
+                for line in book:
+                    file.write(line+"\n")
+            file.flush()
+            os.fsync(file.fileno())
+        if self.__mapped:
+            self.__mapped.close()
+            self.__mapped = None
+        os.replace(self.filename + ".tmp", self.filename)
+        if self.__journal_file:
+            self.__journal_file.close()
+            self.__journal_file = None
+        if self.__journal_len:
+            os.remove(self.journal_name)
+            self.__journal_len = 0
+    
+    def saves_on_write(self, count):              # Перезапишет ли write(count изменений)
+        return not self.journal or self.__journal_len + count >= self.journal_limit # весь файл
+    
+    def write(self, records, books):
+        """
+        Сохраняет пачку изменений и дожидается, пока они окажутся на диске. В режиме
+        журнала дописывает по строке на изменение, так что цена записи зависит от
+        размера изменений, а не от размера каталога. Без журнала, как и раньше,
+        перезаписывается весь файл. books - функция, возвращающая список всех книг,
+        она вызывается только при полной перезаписи, и книги в нём должны быть в
+        том состоянии, в котором их оставила последняя из records: журнал после
+        перезаписи удаляется
+        """
+        if not self.journal:
+            self.save(books())
+            return
+        if not self.__journal_file:
+            self.__journal_file = open(self.journal_name, "a")
+        self.__journal_file.write("".join(json.dumps(record)+"\n" for record in records))
+        self.__journal_file.flush()
+        os.fsync(self.__journal_file.fileno())
+        self.__journal_len += len(records)
+        if self.__journal_len >= self.journal_limit:
+            self.save(books())
+
+
+class SQLiteStorage:
+    """
+    Книги в базе SQLite. База работает в режиме WAL, так что чтение не ждёт запись.
+    На название стоит уникальный индекс, на жанр и авторов - обычные. Каждое
+    изменение - одна короткая транзакция над одной строкой таблицы. Книги
+    загружаются лениво: при запуске читаются только номера строк и названия,
+    остальное - запросом по первичному ключу при первом обращении к книге
+    """
+    def __init__(self, filename, lazy=True):
+        self.filename = filename
+        self.lazy = lazy
+        self.lock = threading.Lock()              # Соединения общие для всех потоков
+        self.__conn = sqlite3.connect(filename, check_same_thread=False)
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        with self.__conn:
+            self.__conn.execute(f"CREATE TABLE IF NOT EXISTS books "
+                                f"(id INTEGER PRIMARY KEY, {', '.join(COLUMNS)})")
+            self.__conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS books_title ON books (title)")
+            self.__conn.execute("CREATE INDEX IF NOT EXISTS books_genre ON books (genre)")
+            self.__conn.execute("CREATE INDEX IF NOT EXISTS books_authors ON books (authors)")
+        self.__reader = sqlite3.connect(filename, check_same_thread=False)
+    
+    def load(self):
+        if self.lazy:
+            rows = self.__conn.execute("SELECT id, title FROM books ORDER BY id").fetchall()
+            for rowid, title in rows:
+                yield Book.lazy(title, self, rowid)
+            return
+        for row in self.__conn.execute(f"SELECT {', '.join(COLUMNS)} FROM books ORDER BY id"):
+            yield Book(row)
+    
+    def read(self, rowid):                        # Дочитывание ленивой книги
+        with self.lock:
+            return list(self.__reader.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM books WHERE id = ?", (rowid,)).fetchone())
+    
+    def replay(self):                             # Журнал ведёт сама база
+        return iter(())
+    
+    def replayed(self, books):
+        pass
+    
+    def save(self, books):
+        """
+        Полная перезапись таблицы одной транзакцией. Принимает книги или списки
+        из 11 строк. Номера строк не меняются: по ним дочитываются ленивые книги,
+        которые остаются в каталоге и после перезаписи. Ленивая книга из этой базы
+        уже лежит в своей строке, и её не нужно ни читать, ни писать. Остальные
+        книги обновляют строку со своим названием, а новые названия добавляются в
+        конец. Строки книг, которых в списке нет, удаляются
+        """
+        ids = dict(self.__conn.execute("SELECT title, id FROM books"))
+        keep, updates, inserts = set(), list(), list()
+        for book in books:
+            if getattr(book, "origin", None) is self:
+                keep.add(book.offset)
+                continue
+            row = list(book)
+            rowid = ids.get(row[0])
+            if rowid is None:
+                inserts.append(row)
+            else:
+                keep.add(rowid)
+                updates.append(row + [rowid])
+        with self.__conn:
+            self.__conn.executemany("DELETE FROM books WHERE id = ?",
+                                    [(rowid,) for rowid in ids.values() if rowid not in keep])
+            self.__conn.executemany(UPDATE_BOOK, updates)
+            self.__conn.executemany(INSERT_BOOK, inserts)
+    
+    def saves_on_write(self, count):              # Каждое изменение - своя строка таблицы
+        return False
+    
+    def write(self, records, books):
+        with self.__conn:                         # Одна транзакция на всю пачку, в которой
+            for record in records:                # каждое изменение касается одной строки
+                match record[0]:
+                    case "add":
+                        self.__conn.execute(INSERT_BOOK, record[1])
+                    case "edit":
+                        self.__conn.execute(f"UPDATE books SET {COLUMNS[record[2]]} = ? "
+                                            f"WHERE title = ?", (record[3], record[1]))
+                    case "remove":
+                        self.__conn.execute("DELETE FROM books WHERE title = ?", (record[1],))
+
+
+COLUMNS = tuple(slot for slot, _, _ in BOOK_FIELDS) # Столбцы таблицы совпадают со слотами Book
+INSERT_BOOK = f"INSERT INTO books ({', '.join(COLUMNS)}) VALUES ({', '.join('?'*len(COLUMNS))})"
+UPDATE_BOOK = f"UPDATE books SET {', '.join(column+' = ?' for column in COLUMNS)} WHERE id = ?"
+
+
+def open_storage(filename, journal=False, journal_limit=JOURNAL_LIMIT, lazy=False):
+    """
+    Выбирает хранилище по расширению файла: базы SQLite узнаются по SQLITE_EXTENSIONS,
+    всё остальное считается текстовым файлом
+    """
+    if filename.endswith(SQLITE_EXTENSIONS):
+        return SQLiteStorage(filename)
+    return TextStorage(filename, journal, journal_limit, lazy)
@@ -1,27 +1,331 @@
 """
-Считывает первые две строки из файла books.txt и создаёт THREAD_COUNT потоков,
-которые бесконечно делают запросы на изменение второй строки в файле. В результате
-файл не изменится, но появится возможность наглядно оценить отказоустойчивость сервера
+Генератор нагрузки для сравнения настроек сервера и поиска регрессий. Запускает
+--clients клиентов, каждый со своим подключением, и в течение --duration секунд
+отправляет команды 1-6 в пропорции --mix, например "2:40,6:40,4:20". Первые
+--warmup секунд запросы идут, но не учитываются: прогреваются кэши и индекс.
+Режимы:
+- closed - каждый клиент отправляет следующий запрос сразу после ответа на
+  предыдущий, так измеряется предельная пропускная способность
+- open - запросы идут с постоянной общей частотой --rate в секунду, как бы сервер
+  ни отвечал. Время ответа считается от момента, когда запрос должен был уйти, а
+  не когда ушёл на самом деле, поэтому медленный сервер не прячет задержки за
+  тем, что клиенты стали реже спрашивать
+Команды не меняют каталог: 4 записывает в поле то же значение, что там было,
+5 удаляет книги, которые клиент сам добавил командой 3 (если таких нет -
+несуществующую книгу), а добавленные, но не удалённые книги удаляются в конце.
+В конце печатается пропускная способность, перцентили времени ответа по командам
+и ошибки, а с --json тот же отчёт пишется в файл. С --baseline отчёт сравнивается
+с прошлым, и если пропускная способность упала или p99 вырос больше чем на
+--tolerance, программа завершается с кодом 1.
+Клиенты - потоки одного процесса, поэтому для нагрузки больше, чем он способен
+создать, можно запустить несколько stress.py одновременно
+Запуск: python stress.py --clients 32 --duration 30 --json result.json
 """
-import socket
+import argparse
+import json
+import os
+import random
+import sys
 import threading
+import time
+from client import CHUNK_SIZE, CMD_SEP, CONFLICT, PORT, Messenger, ServerBusy
 
-PORT = 9090
-THREAD_COUNT = 32
-CMD_SEP = "*-*"
-
-with open("books.txt", "r") as file:
-    book_name = file.readline()[:-1]
-    value = file.readline()[:-1]
-
-def thr():
-    sock = socket.socket()
-    sock.connect(("localhost", PORT))
-    while True:
-        sock.send(("4"+CMD_SEP+book_name+CMD_SEP+"1"+
-                CMD_SEP+value).encode("utf-8"))
-        sock.recv(16384)
-
-for i in range(THREAD_COUNT):
-    t = threading.Thread(target=thr)
-    t.start()
\ No newline at end of file
+HOST = "localhost"
+CLIENTS = 32               # Сколько клиентов одновременно
+MIX = "1:2,2:20,3:5,4:15,5:5,6:53" # Доли команд
+WARMUP = 5                 # Сколько секунд не учитывать в начале
+DURATION = 30              # Сколько секунд измерять после прогрева
+RATE = 1000                # Запросов в секунду от всех клиентов в режиме open
+TIMEOUT = 10               # Сколько секунд ждать ответа, прежде чем считать его ошибкой
+TOLERANCE = 0.1            # Допустимое ухудшение относительно --baseline
+SAMPLE_SIZE = 1000         # Сколько книг взять из каталога для запросов
+SAMPLE_BATCH = 200         # Сколько книг просить одной пачкой (команда 8)
+STRESS_TITLE = "Нагрузка"  # Начало названий книг, которые добавляет команда 3
+PERCENTILES = (50, 90, 95, 99, 99.9)
+COMMANDS = ("1", "2", "3", "4", "5", "6")
+
+
+def parse_mix(mix):                          # "2:40,6:60" -> {"2": 40.0, "6": 60.0}
+    weights = dict()
+    for part in mix.split(","):
+        command, _, weight = part.partition(":")
+        if command not in COMMANDS:
+            raise argparse.ArgumentTypeError(f"неизвестная команда {command}")
+        weights[command] = float(weight or 1)
+    if not any(weights.values()):
+        raise argparse.ArgumentTypeError("все доли нулевые")
+    return weights
+
+
+class LoadClient:
+    """
+    Один клиент нагрузки. Время ответов и ошибки копит у себя и без мьютексов, а
+    сводятся они после остановки всех клиентов
+    """
+    def __init__(self, number, args, sample):
+        self.number = number
+        self.args = args
+        self.sample = sample                 # Книги каталога, по которым идут запросы
+        self.random = random.Random(args.seed + number)
+        self.latencies = {command: list() for command in COMMANDS}
+        self.errors = dict()                 # (команда, вид ошибки) -> сколько раз
+        self.added = list()                  # Названия книг, добавленных командой 3
+        self.counter = 0
+        self.messenger = None
+
+    def connect(self):
+        self.messenger = Messenger(self.args.host, self.args.port, CHUNK_SIZE, CMD_SEP,
+                                   self.args.codec, self.args.compression)
+        self.messenger.sock.settimeout(self.args.timeout)
+
+    def disconnect(self):
+        if self.messenger is not None:
+            self.messenger.sock.close()
+            self.messenger = None
+
+    def execute(self, command):              # Вид ошибки или None, если всё хорошо
+        messenger = self.messenger
+        book = self.random.choice(self.sample)
+        match command:
+            case "1":
+                messenger.send_command("1")
+                messenger.get_data()
+            case "2":                        # Ищем по слову из названия
+                messenger.send_command("2", self.random.choice(book[0].split()))
+                messenger.get_data()
+            case "3":
+                self.counter += 1
+                title = f"{STRESS_TITLE} {os.getpid()} {self.number} {self.counter}"
+                messenger.send_data("3", [title] + book[1:])
+                if not messenger.get_bool():
+                    return "rejected"
+                self.added.append(title)
+            case "4":                        # То же значение, что уже записано
+                result = messenger.edit_book(book[0], 1, book[1])
+                if result == CONFLICT:
+                    return "conflict"
+                if not result:
+                    return "rejected"
+            case "5":
+                if self.added:
+                    if not messenger.remove_book(self.added.pop()):
+                        return "rejected"
+                else:
+                    messenger.remove_book(f"{STRESS_TITLE} {os.getpid()} нет такой")
+            case "6":
+                messenger.send_command("6", book[0])
+                if not messenger.get_data():
+                    return "not_found"
+        return None
+
+    def run(self, measure_from, stop_at, interval=None):
+        """
+        Закрытый цикл, если interval не задан, иначе открытый: запросы уходят раз в
+        interval секунд, а первый - в случайный момент первого интервала, чтобы
+        клиенты не стреляли одновременно
+        """
+        commands = list(self.args.mix)
+        weights = list(self.args.mix.values())
+        scheduled = time.perf_counter()
+        if interval is not None:
+            scheduled += self.random.uniform(0, interval)
+        while True:
+            if interval is not None:
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            start = scheduled if interval is not None else time.perf_counter()
+            if start >= stop_at:
+                break
+            if interval is not None and time.perf_counter() >= stop_at:
+                missed = int((stop_at - max(start, measure_from)) / interval) + 1
+                self.errors[None, "missed"] = missed # Отстали от расписания: запросы,
+                break                                # которые не успели уйти, - ошибки
+            command = self.random.choices(commands, weights)[0]
+            error = self.request(command)
+            if start >= measure_from:
+                if error is None:
+                    self.latencies[command].append(time.perf_counter() - start)
+                else:
+                    key = (command, error)
+                    self.errors[key] = self.errors.get(key, 0) + 1
+            if interval is not None:
+                scheduled += interval
+        self.cleanup()
+
+    def request(self, command):
+        try:
+            if self.messenger is None:
+                self.connect()
+            return self.execute(command)
+        except ServerBusy:
+            self.disconnect()
+            return "busy"
+        except TimeoutError:                 # Ответ мог прийти позже и перепутаться
+            self.disconnect()                # со следующим, поэтому переподключаемся
+            return "timeout"
+        except OSError:                      # ConnectionError тоже OSError
+            self.disconnect()
+            time.sleep(0.1)                  # Не долбим упавший сервер
+            return "connection"
+
+    def cleanup(self):                       # Убираем за собой добавленные книги
+        try:
+            if self.added:
+                if self.messenger is None:
+                    self.connect()
+                self.messenger.batch([["remove", title] for title in self.added])
+            self.disconnect()
+        except OSError:
+            pass
+
+
+def load_sample(args):
+    """
+    Книги, по которым клиенты будут делать запросы: случайные SAMPLE_SIZE названий
+    из каталога, а сами книги - пачками командой 8
+    """
+    messenger = Messenger(args.host, args.port, CHUNK_SIZE, CMD_SEP)
+    messenger.send_command("1")
+    titles = [title for title in messenger.get_data()
+              if not title.startswith(STRESS_TITLE)]
+    titles = random.Random(args.seed).sample(titles, min(SAMPLE_SIZE, len(titles)))
+    sample = list()
+    for start in range(0, len(titles), SAMPLE_BATCH):
+        sample += messenger.batch([["get", title]
+                                   for title in titles[start:start+SAMPLE_BATCH]])
+    messenger.send_command("0")
+    messenger.sock.close()
+    return [book for book in sample if book]
+
+
+def percentile(values, percent):             # values уже отсортированы
+    return values[min(len(values)-1, int(len(values) * percent / 100))]
+
+def summarize(latencies, errors):
+    latencies = sorted(latencies)
+    summary = {"requests": len(latencies), "errors": errors}
+    if latencies:
+        summary["mean"] = round(sum(latencies) / len(latencies) * 1000, 3)
+        for percent in PERCENTILES:
+            summary[f"p{percent:g}"] = round(percentile(latencies, percent) * 1000, 3)
+        summary["max"] = round(latencies[-1] * 1000, 3)
+    return summary
+
+def build_report(args, clients, elapsed):
+    """
+    Отчёт: общие цифры, по каждой команде (времена в миллисекундах) и ошибки по
+    видам. Ошибочные запросы в перцентили не входят, а считаются отдельно.
+    Запросы режима open, которые так и не ушли до конца измерения (missed), не
+    относятся ни к одной команде и видны только в общих ошибках
+    """
+    errors, command_errors = dict(), dict()
+    for client in clients:
+        for (command, error), count in client.errors.items():
+            errors[error] = errors.get(error, 0) + count
+            if command is not None:
+                command_errors[command] = command_errors.get(command, 0) + count
+    commands = {command: summarize([latency for client in clients
+                                    for latency in client.latencies[command]],
+                                   command_errors.get(command, 0))
+                for command in args.mix}
+    total = summarize([latency for client in clients
+                       for latencies in client.latencies.values()
+                       for latency in latencies], sum(errors.values()))
+    config = {key: value for key, value in vars(args).items()
+              if key not in ("json", "baseline")}
+    return {"config": config, "duration": round(elapsed, 3),
+            "throughput": round(total["requests"] / elapsed, 1),
+            "total": total, "commands": commands, "errors": errors}
+
+def print_report(report):
+    columns = ["mean"] + [f"p{percent:g}" for percent in PERCENTILES] + ["max"]
+    print(f"{'команда':>8} {'запросов':>9} {'ошибок':>7}" +
+          "".join(f"{column:>9}" for column in columns))
+    rows = list(report["commands"].items()) + [("всего", report["total"])]
+    for command, summary in rows:
+        print(f"{command:>8} {summary['requests']:>9} {summary['errors']:>7}" +
+              "".join(f"{summary.get(column, 0):>9.2f}" for column in columns))
+    print(f"Время ответа в миллисекундах. {report['total']['requests']} запросов за "
+          f"{report['duration']:.1f} с: {report['throughput']} запросов в секунду")
+    for error, count in sorted(report["errors"].items()):
+        print(f"Ошибки {error}: {count}")
+
+def compare(report, baseline, tolerance):   # Список ухудшений относительно baseline
+    regressions = list()
+    if report["throughput"] < baseline["throughput"] * (1 - tolerance):
+        regressions.append(f"пропускная способность {report['throughput']} "
+                           f"против {baseline['throughput']}")
+    for command, summary in [("всего", report["total"])] + \
+                            list(report["commands"].items()):
+        old = baseline["total"] if command == "всего" else \
+              baseline["commands"].get(command)
+        if old and "p99" in old and summary.get("p99", 0) > old["p99"] * (1 + tolerance):
+            regressions.append(f"p99 команды {command} {summary['p99']} мс "
+                               f"против {old['p99']} мс")
+    return regressions
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Генератор нагрузки на сервер библиотеки")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--clients", type=int, default=CLIENTS,
+                        help="сколько клиентов (подключений) одновременно")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(MIX),
+                        help="доли команд 1-6, например 2:40,6:40,4:20")
+    parser.add_argument("--mode", choices=("closed", "open"), default="closed",
+                        help="closed - запрос сразу после ответа, open - с частотой --rate")
+    parser.add_argument("--rate", type=float, default=RATE,
+                        help="запросов в секунду от всех клиентов в режиме open")
+    parser.add_argument("--warmup", type=float, default=WARMUP,
+                        help="сколько секунд не учитывать в начале")
+    parser.add_argument("--duration", type=float, default=DURATION,
+                        help="сколько секунд измерять")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT,
+                        help="сколько секунд ждать ответа")
+    parser.add_argument("--codec", default="json", help="кодек подключения")
+    parser.add_argument("--compression", default="none", help="сжатие ответов")
+    parser.add_argument("--seed", type=int, default=0, help="зерно случайных чисел")
+    parser.add_argument("--json", help="файл для отчёта в json")
+    parser.add_argument("--baseline", help="отчёт прошлого запуска для сравнения")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="допустимое ухудшение, 0.1 - на 10%%")
+    return parser
+
+def main():
+    args = build_parser().parse_args()
+    try:
+        sample = load_sample(args)
+    except OSError as e:
+        sys.exit(f"Сервер недоступен: {e}")
+    if not sample:
+        sys.exit("В каталоге нет книг для запросов")
+    clients = [LoadClient(number, args, sample) for number in range(args.clients)]
+    interval = args.clients / args.rate if args.mode == "open" else None
+    start = time.perf_counter()
+    measure_from = start + args.warmup
+    stop_at = measure_from + args.duration
+    threads = [threading.Thread(target=client.run, args=(measure_from, stop_at, interval))
+               for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = min(time.perf_counter(), stop_at) - measure_from
+    report = build_report(args, clients, elapsed)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        for regression in regressions:
+            print("Ухудшение:", regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()